@@ -0,0 +1,243 @@
+"""Checks the resumable downloader against a local HTTP stand-in for Dropbox.
+
+A throwaway `http.server` on localhost serves an audio and a spectrogram archive, with Range
+support that can be switched off, and can cut its first response short. The archives are
+fetched through `AUDIO_ZIP_URL` / `SPECTRO_ZIP_URL` with `fetch_archive` into a temporary
+directory (the package's data directory is left alone), and the script checks that:
+
+- an interrupted download resumes with a 206 and the files are extracted intact,
+- a server that ignores Range restarts the download from scratch,
+- a complete `.part` file (416 on resume) is kept as is,
+- a wrong `*_SHA256` is rejected and the `.part` file is deleted,
+- an extracted archive is not fetched again, and an interrupted extraction only rewrites
+  the members that are incomplete.
+
+    PYTHONPATH=src python benchmarks/download_resume.py
+"""
+import importlib
+import io
+import os
+import re
+import shutil
+import tempfile
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StandIn:
+    """Archives served by the stand-in, its behaviour switches and a log of the responses."""
+
+    def __init__(self):
+        self.files = {}  # URL path -> bytes
+        self.cut_next = False  # Close the next full response halfway through
+        self.ignore_range = False
+        self.log = []  # (path, Range header, status)
+
+    def reset(self, cut_next=False, ignore_range=False):
+        self.cut_next = cut_next
+        self.ignore_range = ignore_range
+        self.log = []
+
+    def statuses(self):
+        return [status for _, _, status in self.log]
+
+
+def make_handler(stand_in):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if path not in stand_in.files:
+                self.send_error(404)
+                return
+            data = stand_in.files[path]
+
+            range_header = self.headers.get("Range")
+            match = re.fullmatch(r"bytes=(\d+)-", range_header or "")
+            start = int(match.group(1)) if match and not stand_in.ignore_range else 0
+
+            if start >= len(data) and start > 0:
+                stand_in.log.append((path, range_header, 416))
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            status = 206 if start else 200
+            stand_in.log.append((path, range_header, status))
+            self.send_response(status)
+            if status == 206:
+                self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+            self.send_header("Content-Length", str(len(data) - start))
+            self.send_header("Connection", "close")
+            self.end_headers()
+
+            body = data[start:]
+            if stand_in.cut_next:
+                stand_in.cut_next = False
+                body = body[: len(body) // 2]
+            self.wfile.write(body)
+            self.wfile.flush()
+            self.close_connection = True
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def make_zip(members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zip_ref:
+        for name, data in members.items():
+            zip_ref.writestr(name, data)
+    return buffer.getvalue()
+
+
+def main():
+    audio = {f"train_soundscapes/{i}_SSW_20170101.ogg": os.urandom(300_000) for i in range(3)}
+    spectrograms = {
+        f"spectrograms/{i}_SSW_20170101/spectrogram.pt": os.urandom(200_000) for i in range(3)
+    }
+    stand_in = StandIn()
+    stand_in.files["/audio.zip"] = make_zip(
+        {**audio, "__MACOSX/train_soundscapes/._0_SSW_20170101.ogg": b"junk"}
+    )
+    stand_in.files["/spectrograms.zip"] = make_zip(spectrograms)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(stand_in))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    os.environ["AUDIO_ZIP_URL"] = f"{base_url}/audio.zip"
+    os.environ["SPECTRO_ZIP_URL"] = f"{base_url}/spectrograms.zip"
+    from dummy_server.downloader import download
+
+    download = importlib.reload(download)  # Reads the URLs at import time
+
+    def extract_audio(zip_path, target_dir):
+        download.extract_zip_flat(zip_path, ".ogg", target_dir)
+
+    def assert_extracted(target_dir, members, prefix):
+        for name, data in members.items():
+            path = os.path.join(target_dir, os.path.relpath(name, prefix))
+            with open(path, "rb") as f:
+                assert f.read() == data, f"{path} is not intact"
+
+    root = tempfile.mkdtemp()
+    try:
+        # Interrupted downloads resume with a Range request
+        stand_in.reset(cut_next=True)
+        zip_path = os.path.join(root, "audio.zip")
+        audio_dir = os.path.join(root, "audio")
+        download.fetch_archive(
+            download.AUDIO_ZIP_URL, download.AUDIO_ZIP_SHA256, zip_path, audio_dir, extract_audio
+        )
+        assert stand_in.statuses() == [200, 206], stand_in.log
+        assert_extracted(audio_dir, audio, "train_soundscapes")
+        assert sorted(os.listdir(audio_dir)) == sorted(os.path.basename(n) for n in audio)
+        assert os.path.exists(f"{zip_path}.extracted")
+        print(">>> ok: interrupted download resumed with a 206, files extracted intact")
+
+        stand_in.reset(cut_next=True)
+        zip_path = os.path.join(root, "spectrograms.zip")
+        spectrogram_dir = os.path.join(root, "spectrograms")
+        download.fetch_archive(
+            download.SPECTRO_ZIP_URL,
+            download.SPECTRO_ZIP_SHA256,
+            zip_path,
+            spectrogram_dir,
+            download.extract_zip_preserve_structure,
+        )
+        assert stand_in.statuses() == [200, 206], stand_in.log
+        assert_extracted(spectrogram_dir, spectrograms, "spectrograms")
+        print(">>> ok: spectrogram archive resumed and extracted with its structure")
+
+        # Already extracted: nothing is fetched again
+        stand_in.reset()
+        download.fetch_archive(
+            download.SPECTRO_ZIP_URL,
+            download.SPECTRO_ZIP_SHA256,
+            zip_path,
+            spectrogram_dir,
+            download.extract_zip_preserve_structure,
+        )
+        assert stand_in.log == [], stand_in.log
+        print(">>> ok: extracted archive not downloaded again")
+
+        # A server that ignores Range sends everything again, the .part file is restarted
+        stand_in.reset(cut_next=True, ignore_range=True)
+        output_path = os.path.join(root, "no_range.zip")
+        download.download_file(download.AUDIO_ZIP_URL, output_path)
+        assert stand_in.statuses() == [200, 200], stand_in.log
+        with open(output_path, "rb") as f:
+            assert f.read() == stand_in.files["/audio.zip"]
+        print(">>> ok: download restarted when the server ignores Range")
+
+        # A complete .part file gets a 416 on resume and is kept
+        stand_in.reset()
+        output_path = os.path.join(root, "complete.zip")
+        with open(f"{output_path}.part", "wb") as f:
+            f.write(stand_in.files["/audio.zip"])
+        download.download_file(download.AUDIO_ZIP_URL, output_path)
+        assert stand_in.statuses() == [416], stand_in.log
+        with open(output_path, "rb") as f:
+            assert f.read() == stand_in.files["/audio.zip"]
+        print(">>> ok: complete .part file kept on a 416")
+
+        # A wrong checksum is rejected and the .part file is removed
+        os.environ["AUDIO_ZIP_SHA256"] = "0" * 64
+        download = importlib.reload(download)
+        stand_in.reset()
+        zip_path = os.path.join(root, "bad", "audio.zip")
+        os.makedirs(os.path.dirname(zip_path))
+        try:
+            download.fetch_archive(
+                download.AUDIO_ZIP_URL,
+                download.AUDIO_ZIP_SHA256,
+                zip_path,
+                os.path.join(root, "bad", "audio"),
+                extract_audio,
+            )
+        except ValueError as e:
+            assert "Checksum mismatch" in str(e)
+        else:
+            raise AssertionError("wrong AUDIO_ZIP_SHA256 was accepted")
+        assert not os.path.exists(f"{zip_path}.part") and not os.path.exists(zip_path)
+        assert not os.path.exists(f"{zip_path}.extracted")
+        print(">>> ok: wrong AUDIO_ZIP_SHA256 rejected, .part file deleted")
+        del os.environ["AUDIO_ZIP_SHA256"]
+        download = importlib.reload(download)
+
+        # Interrupted extraction: the archive is still there and no marker was written. Complete
+        # members are skipped, the truncated one is extracted again.
+        os.remove(os.path.join(root, "audio.zip.extracted"))
+        names = sorted(os.path.basename(name) for name in audio)
+        complete_path = os.path.join(audio_dir, names[0])
+        truncated_path = os.path.join(audio_dir, names[1])
+        os.utime(complete_path, (0, 0))
+        with open(truncated_path, "r+b") as f:
+            f.truncate(1000)
+        stand_in.reset()
+        download.fetch_archive(
+            download.AUDIO_ZIP_URL,
+            download.AUDIO_ZIP_SHA256,
+            os.path.join(root, "audio.zip"),
+            audio_dir,
+            extract_audio,
+        )
+        assert stand_in.log == [], stand_in.log
+        assert os.path.getmtime(complete_path) == 0, "complete member was rewritten"
+        assert_extracted(audio_dir, audio, "train_soundscapes")
+        assert os.path.exists(os.path.join(root, "audio.zip.extracted"))
+        print(">>> ok: interrupted extraction resumed, complete members skipped")
+    finally:
+        server.shutdown()
+        shutil.rmtree(root)
+
+    print(">>> All downloader checks passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""Hammers the /label write path while a retrain writes uncertainties back.
+
+By default everything runs in-process against a throwaway SQLite database: label threads
+post to `/label` (or, with --batch, to `/labels`) through the Flask test client, so they run
+the request handlers themselves; reader threads run the `/audio` selection query,
+and a "retrain" thread rewrites the uncertainty of every segment with the scoring write-back
+(`bulk_update_uncertainty`, chunked by UNCERTAINTY_WRITE_CHUNK).
+Compare storage settings through the environment, e.g.:
+
+    python benchmarks/label_concurrency.py
+    DB_JOURNAL_MODE=DELETE DB_SYNCHRONOUS=FULL python benchmarks/label_concurrency.py
+
+With --url, the label requests are sent to a running server instead (this labels real
+segments, so only point it at a disposable database, e.g. started with RESET_DB=1).
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+
+def summarize(name, latencies, errors, elapsed):
+    if not latencies:
+        print(f"{name:>8}: no successful operations, {errors} errors")
+        return
+    ms = np.array(latencies) * 1000
+    print(
+        f"{name:>8}: {len(ms):6d} ops {len(ms) / elapsed:8.1f} ops/s | "
+        f"p50 {np.percentile(ms, 50):7.1f} ms  p95 {np.percentile(ms, 95):7.1f} ms  "
+        f"p99 {np.percentile(ms, 99):7.1f} ms  max {ms.max():7.1f} ms | {errors} errors"
+    )
+
+
+def run_in_process(args):
+    from flask import Flask
+    from flask_restful import Api
+    from dummy_server.db import sqlite
+    from dummy_server.db.sqlite import (
+        Audio,
+        Segment,
+        db,
+        configure_db,
+        most_uncertain_segment,
+        bulk_update_uncertainty,
+        set_meta,
+    )
+    from dummy_server.resources.label import LabelBatchResource, LabelResource
+
+    tmp_dir = tempfile.mkdtemp()
+    app = Flask(__name__)
+    configure_db(app, f"sqlite:///{os.path.join(tmp_dir, 'bench.db')}")
+    api = Api(app)
+    api.add_resource(LabelResource, "/label")
+    api.add_resource(LabelBatchResource, "/labels")
+
+    with app.app_context():
+        db.create_all()
+        filenames = [f"{i}_BENCH_20190101.ogg" for i in range(args.audio_files)]
+        db.session.execute(
+            db.insert(Audio), [{"filename": f, "duration": 600.0} for f in filenames]
+        )
+        db.session.execute(
+            db.insert(Segment),
+            [
+                {"audio_id": audio_id, "t_start": i * 5, "uncertainty": -1.0}
+                for (audio_id,) in db.session.query(Audio.id)
+                for i in range(120)
+            ],
+        )
+        db.session.commit()
+        # Like `init_db`, which starts the counters that `label_segments` keeps up to date
+        set_meta(labeled_count=0, label_changes=0)
+        segment_ids = [seg_id for (seg_id,) in db.session.query(Segment.id)]
+        # (filename, segment ids in time order) of every audio file, for the expert windows
+        audio_segments = [
+            (
+                audio.filename,
+                [
+                    seg_id
+                    for (seg_id,) in db.session.query(Segment.id)
+                    .filter_by(audio_id=audio.id)
+                    .order_by(Segment.t_start)
+                ],
+            )
+            for audio in Audio.query.all()
+        ]
+
+    print(
+        f"{len(segment_ids)} segments, journal_mode={sqlite.DB_JOURNAL_MODE}, "
+        f"synchronous={sqlite.DB_SYNCHRONOUS}, pool_size={sqlite.DB_POOL_SIZE}"
+    )
+
+    stop = threading.Event()
+    results = {"label": ([], [0]), "read": ([], [0]), "retrain": ([], [0])}
+
+    def timed(kind, fn):
+        latencies, errors = results[kind]
+        start = time.perf_counter()
+        try:
+            fn()
+            latencies.append(time.perf_counter() - start)
+        except Exception:
+            db.session.rollback()
+            errors[0] += 1
+
+    client = app.test_client()
+
+    def label_once():
+        filename, audio_segment_ids = random.choice(audio_segments)
+        if args.batch > 1:
+            start = random.randrange(len(audio_segment_ids) - args.batch + 1)
+            response = client.post(
+                "/labels",
+                json={
+                    "audio_filename": filename,
+                    "labels": [
+                        {"segment_id": segment_id, "labels": ["No birds"]}
+                        for segment_id in audio_segment_ids[start : start + args.batch]
+                    ],
+                },
+            )
+        else:
+            response = client.post(
+                "/label",
+                json={
+                    "audio_filename": filename,
+                    "segment_id": random.choice(audio_segment_ids),
+                    "labels": ["No birds"],
+                },
+            )
+        if response.status_code != 200:
+            raise RuntimeError(response.get_json())
+
+    def retrain_once():
+        bulk_update_uncertainty(segment_ids, np.random.rand(len(segment_ids)).round(4))
+
+    def worker(kind, fn, pause):
+        with app.app_context():
+            while not stop.is_set():
+                timed(kind, fn)
+                time.sleep(pause)
+            db.session.remove()
+
+    threads = [
+        threading.Thread(target=worker, args=("label", label_once, 0.0))
+        for _ in range(args.threads)
+    ]
+    threads += [
+        threading.Thread(target=worker, args=("read", most_uncertain_segment, 0.0))
+        for _ in range(args.readers)
+    ]
+    threads.append(threading.Thread(target=worker, args=("retrain", retrain_once, 0.5)))
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    for kind, (latencies, errors) in results.items():
+        summarize(kind, latencies, errors[0], elapsed)
+
+
+def run_http(args):
+    import requests
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Collect windows of (audio filename, segment ids) from the expert view, one per request
+    targets = []
+    while len(targets) < args.requests:
+        metadata = requests.get(f"{args.url}/audio", params={"mode": "expert"}).json()
+        segment_ids = [seg["id"] for seg in metadata["segments"]]
+        targets += [
+            (metadata["filename"], segment_ids[start : start + args.batch])
+            for start in range(0, len(segment_ids), args.batch)
+        ]
+    targets = targets[: args.requests]
+
+    latencies, errors = [], [0]
+
+    def post(target):
+        filename, segment_ids = target
+        start = time.perf_counter()
+        if args.batch > 1:
+            response = requests.post(
+                f"{args.url}/labels",
+                json={
+                    "audio_filename": filename,
+                    "labels": [
+                        {"segment_id": segment_id, "labels": ["No birds"]}
+                        for segment_id in segment_ids
+                    ],
+                },
+            )
+        else:
+            response = requests.post(
+                f"{args.url}/label",
+                json={
+                    "audio_filename": filename,
+                    "segment_id": segment_ids[0],
+                    "labels": ["No birds"],
+                },
+            )
+        if response.ok:
+            latencies.append(time.perf_counter() - start)
+        else:
+            errors[0] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        list(executor.map(post, targets))
+    summarize("label", latencies, errors[0], time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="Benchmark a running server instead of in-process")
+    parser.add_argument("--threads", type=int, default=8, help="Concurrent label writers")
+    parser.add_argument("--readers", type=int, default=4, help="Concurrent /audio readers")
+    parser.add_argument("--audio-files", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds (in-process)")
+    parser.add_argument("--requests", type=int, default=400, help="Label requests (--url)")
+    parser.add_argument(
+        "--batch",
+        type=int,
+        default=1,
+        help="Segments per request, above 1 they are posted to /labels (e.g. 12, an expert window)",
+    )
+    args = parser.parse_args()
+
+    if args.url:
+        run_http(args)
+    else:
+        run_in_process(args)
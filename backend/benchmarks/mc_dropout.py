@@ -0,0 +1,88 @@
+"""Compares MC-dropout scoring throughput of the classifier head, in segments/sec.
+
+Runs on random pooled features, so no data or pretrained weights are needed:
+
+    PYTHONPATH=src python benchmarks/mc_dropout.py
+    PYTHONPATH=src python benchmarks/mc_dropout.py --threads 1 --compile
+
+"repeat" is the previous implementation (features repeated `num_preds` times, BALD computed
+twice), "vectorized" is `mc_dropout_logits`, alone, under bfloat16 autocast and compiled.
+"""
+import argparse
+import time
+
+import torch
+
+from dummy_server.model.bird_classifier import (
+    NUM_CLASSES,
+    bald,
+    make_head,
+    mc_dropout_logits,
+)
+
+CLASSIFIER_IN = 1280  # efficientnet_b0
+
+
+def repeat_inference(head, pooled, num_preds):
+    head.train()
+    repeated = pooled.unsqueeze(0).repeat(num_preds, 1, 1).view(-1, pooled.shape[1])
+    probs = torch.sigmoid(head(repeated)).view(num_preds, -1, NUM_CLASSES)
+    return probs.mean(dim=0), bald(probs)[0], bald(probs)[1]
+
+
+def vectorized_inference(
+    head, pooled, num_preds, logits_fn=mc_dropout_logits, bfloat16=False
+):
+    with torch.autocast(
+        device_type=pooled.device.type, dtype=torch.bfloat16, enabled=bfloat16
+    ):
+        logits = logits_fn(head, pooled, num_preds)
+    probs = torch.sigmoid(logits.float())
+    mutual_information, predictive_entropy = bald(probs)
+    return probs.mean(dim=0), mutual_information, predictive_entropy
+
+
+def measure(name, fn, pooled, iterations, warmup=2):
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn(pooled)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn(pooled)
+        elapsed = time.perf_counter() - start
+    rate = iterations * len(pooled) / elapsed
+    print(f"{name:>22}: {rate:10.0f} segments/s")
+    return rate
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=1024)
+    parser.add_argument("--num-preds", type=int, default=10)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=None, help="torch CPU threads")
+    parser.add_argument("--compile", action="store_true", help="Also time torch.compile")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    head = make_head(CLASSIFIER_IN, NUM_CLASSES).eval()
+    pooled = torch.randn(args.batch_size, CLASSIFIER_IN)
+    n = args.num_preds
+    print(f"batch {args.batch_size}, {n} dropout samples, {torch.get_num_threads()} threads")
+
+    baseline = measure("repeat", lambda x: repeat_inference(head, x, n), pooled, args.iterations)
+    candidates = {
+        "vectorized": lambda x: vectorized_inference(head, x, n),
+        "vectorized bfloat16": lambda x: vectorized_inference(head, x, n, bfloat16=True),
+    }
+    if args.compile:
+        compiled = torch.compile(mc_dropout_logits)
+        candidates["vectorized compiled"] = lambda x: vectorized_inference(
+            head, x, n, logits_fn=compiled
+        )
+
+    for name, fn in candidates.items():
+        rate = measure(name, fn, pooled, args.iterations)
+        print(f"{'':>22}  {rate / baseline:.2f}x repeat")
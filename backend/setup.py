@@ -21,6 +21,7 @@ setup(
     entry_points={
         "console_scripts": [
             "start-server = dummy_server.router.app:start_server",
+            "start-worker = dummy_server.model.worker:main",
         ]
     },
     install_requires=[
@@ -38,6 +39,7 @@ setup(
         "tqdm>=4.65.0",
         "librosa==0.9.2",
         "timm==1.0.15",
+        "gunicorn>=22.0",
     ],
     packages=find_packages(where="src"),
     package_dir={"": "src"},
@@ -0,0 +1,96 @@
+import argparse
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from tqdm import tqdm
+
+from dummy_server.cache.disk_lru import DiskLRU
+from dummy_server.constants import AUDIO_DIR, CLIP_CACHE_DIR, CLIP_CACHE_MAX_BYTES
+
+# Windows served to the layman (one segment) and expert (one minute) views
+STANDARD_WINDOWS = (5, 60)
+# Soundscapes are 120 segments of 5 seconds
+AUDIO_DURATION = 600.0
+
+
+def clip_key(filename, start, end):
+    audio_name = os.path.splitext(filename)[0]
+    return os.path.join(audio_name, f"{start:.3f}-{end:.3f}.ogg")
+
+
+def cut_clip(file_path, start, end, output_path):
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-y",
+            "-loglevel",
+            "error",
+            "-i",
+            file_path,
+            "-ss",
+            str(start),
+            "-t",
+            str(end - start),
+            "-acodec",
+            "copy",
+            output_path,
+        ],
+        check=True,
+    )
+
+
+class ClipCache:
+    """Cache of audio clips keyed by (filename, start, end), cut with ffmpeg on a miss."""
+
+    def __init__(self, audio_dir=AUDIO_DIR, cache_dir=CLIP_CACHE_DIR, max_bytes=CLIP_CACHE_MAX_BYTES):
+        self.audio_dir = audio_dir
+        self.lru = DiskLRU(cache_dir, max_bytes)
+
+    def get_clip(self, filename, start, end):
+        """Returns the path of the cached clip, cutting it first if needed."""
+        start, end = round(start, 3), round(end, 3)
+        key = clip_key(filename, start, end)
+
+        file_path = os.path.join(self.audio_dir, filename)
+        return self.lru.get_or_create(
+            key, lambda tmp_path: cut_clip(file_path, start, end, tmp_path)
+        )
+
+    def precut(self, filenames=None, windows=STANDARD_WINDOWS, duration=AUDIO_DURATION, workers=None):
+        """Cuts the standard windows of every audio file ahead of time."""
+        if filenames is None:
+            filenames = sorted(f for f in os.listdir(self.audio_dir) if f.endswith(".ogg"))
+
+        jobs = [
+            (filename, float(start), float(start + window))
+            for filename in filenames
+            for window in windows
+            for start in range(0, int(duration), window)
+        ]
+
+        # The work happens in ffmpeg subprocesses, so threads are enough
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+            futures = [executor.submit(self.get_clip, *job) for job in jobs]
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Pre-cutting clips"):
+                future.result()
+
+        print(f">>> Pre-cut {len(jobs)} clips ({self.lru.total_bytes / 1024 ** 2:.1f} MB cached)")
+
+
+clip_cache = ClipCache()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-cut the standard audio clip windows.")
+    parser.add_argument(
+        "--windows",
+        type=int,
+        nargs="+",
+        default=list(STANDARD_WINDOWS),
+        help="Window lengths in seconds",
+    )
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    clip_cache.precut(windows=args.windows, workers=args.workers)
@@ -0,0 +1,156 @@
+import fcntl
+import os
+import uuid
+import zlib
+from contextlib import contextmanager
+
+# Bookkeeping files inside the cache directory (dot files and directories are never entries)
+LOCK_FILENAME = ".lru.lock"
+USAGE_FILENAME = ".lru.usage"
+KEY_LOCK_DIR = ".locks"
+# Misses are deduplicated through this many lock files, keys are spread over them by hash
+KEY_LOCK_STRIPES = 256
+
+
+class DiskLRU:
+    """Size-bounded directory of cached files, evicting the least recently used ones.
+
+    Keys are relative paths inside `root`. Hits bump the modification time and eviction removes
+    the oldest files, so the recency order is the one on disk and survives restarts.
+
+    The directory can be shared by several processes, e.g. the gunicorn workers: the byte total
+    is kept in a file next to the entries and only updated under an `fcntl` lock, eviction
+    re-measures the directory under that lock, and concurrent misses for the same key wait on a
+    per-key file lock. `max_bytes` therefore bounds all the workers together, and every entry
+    is created once.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    @contextmanager
+    def _flock(self, name):
+        # Every call opens its own descriptor, so the lock also excludes the other threads
+        os.makedirs(os.path.dirname(os.path.join(self.root, name)), exist_ok=True)
+        with open(os.path.join(self.root, name), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _measure(self):
+        """Returns the (modification time, key, size) of the entries on disk, oldest first."""
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            for fname in filenames:
+                if fname.startswith(".") or ".tmp-" in fname:
+                    continue
+                path = os.path.join(dirpath, fname)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, os.path.relpath(path, self.root), stat.st_size))
+        return sorted(files)
+
+    def _read_usage(self):
+        try:
+            with open(os.path.join(self.root, USAGE_FILENAME)) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_usage(self, total):
+        with open(os.path.join(self.root, USAGE_FILENAME), "w") as f:
+            f.write(str(total))
+
+    def get(self, key):
+        """Returns the path of a cached entry (marking it as recently used), or None."""
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, write):
+        """Creates an entry by calling `write(tmp_path)`, then makes it visible atomically."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        base, ext = os.path.splitext(path)
+        tmp_path = f"{base}.tmp-{uuid.uuid4().hex}{ext}"
+        try:
+            write(tmp_path)
+            size = os.path.getsize(tmp_path)
+            with self._flock(LOCK_FILENAME):
+                try:
+                    previous_size = os.path.getsize(path)
+                except FileNotFoundError:
+                    previous_size = 0
+                os.replace(tmp_path, path)
+
+                total = self._read_usage()
+                if total is None:
+                    total = sum(size for _, _, size in self._measure())
+                else:
+                    total += size - previous_size
+                if total > self.max_bytes:
+                    total = self._evict(keep=key)
+                self._write_usage(total)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return path
+
+    def get_or_create(self, key, write):
+        """Like `get`, creating the entry with `put` on a miss.
+
+        Concurrent misses for the same key, in this process or another one, are deduplicated:
+        one creates the entry while the others wait for it and then share the result.
+        """
+        path = self.get(key)
+        if path is not None:
+            return path
+
+        stripe = zlib.crc32(key.encode()) % KEY_LOCK_STRIPES
+        with self._flock(os.path.join(KEY_LOCK_DIR, f"{stripe}.lock")):
+            path = self.get(key)
+            if path is None:
+                path = self.put(key, write)
+            return path
+
+    def _evict(self, keep):
+        """Removes the oldest entries until the directory fits in `max_bytes`; returns its size.
+
+        The directory is measured again rather than trusting the running total, so entries
+        added or removed by other processes are accounted for.
+        """
+        files = self._measure()
+        total = sum(size for _, _, size in files)
+        for _, key, size in files:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            try:
+                # Files that are being streamed stay readable through their open descriptor
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
+
+    @property
+    def total_bytes(self):
+        with self._flock(LOCK_FILENAME):
+            total = self._read_usage()
+            if total is None:
+                total = sum(size for _, _, size in self._measure())
+            return total
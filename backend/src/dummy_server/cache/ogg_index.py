@@ -0,0 +1,146 @@
+import bisect
+import json
+import os
+import struct
+from functools import lru_cache
+
+from dummy_server.constants import AUDIO_DIR, OGG_INDEX_DIR
+
+OGG_CAPTURE_PATTERN = b"OggS"
+OGG_PAGE_HEADER = struct.Struct("<4sBBqIIIB")  # 27 bytes, followed by the segment table
+# Bumped when the persisted indexes must be rebuilt
+INDEX_FORMAT = 2
+
+
+class OggSeekIndex:
+    """Maps times to byte offsets of an Ogg (Vorbis or Opus) file, one entry per page.
+
+    A time window maps to the byte range of the pages that contain it. Together with the header
+    pages (`header_bytes`), such a range can be fetched with plain HTTP Range requests, so a
+    window can be served by a CDN or nginx without re-encoding anything.
+    """
+
+    def __init__(self, sample_rate, pre_skip, header_bytes, page_offsets, page_granules, size):
+        self.sample_rate = sample_rate
+        self.pre_skip = pre_skip
+        self.header_bytes = header_bytes
+        self.page_offsets = page_offsets  # byte offset at which each audio page starts
+        self.page_granules = page_granules  # granule position at which each audio page ends
+        self.size = size
+
+    @property
+    def duration(self):
+        if not self.page_granules:
+            return 0.0
+        return max(self.page_granules[-1] - self.pre_skip, 0) / self.sample_rate
+
+    def byte_range(self, start, end):
+        """Returns the [first, last) byte offsets of the pages covering [start, end) seconds."""
+        if not self.page_offsets:
+            return self.header_bytes, self.header_bytes
+
+        def page_at(sample):
+            granule = sample + self.pre_skip
+            # First page ending after the granule, i.e. the page that contains it
+            return min(bisect.bisect_right(self.page_granules, granule), len(self.page_offsets) - 1)
+
+        first = page_at(int(start * self.sample_rate))
+        last = page_at(max(int(end * self.sample_rate) - 1, 0))
+        stop = self.page_offsets[last + 1] if last + 1 < len(self.page_offsets) else self.size
+        return self.page_offsets[first], stop
+
+    def to_dict(self):
+        return {
+            "sample_rate": self.sample_rate,
+            "pre_skip": self.pre_skip,
+            "header_bytes": self.header_bytes,
+            "page_offsets": self.page_offsets,
+            "page_granules": self.page_granules,
+            "size": self.size,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    @classmethod
+    def build(cls, file_path):
+        """Scans the page headers of the file (page bodies are skipped, not read)."""
+        sample_rate = None
+        pre_skip = 0
+        header_bytes = None
+        page_offsets = []
+        page_granules = []
+
+        with open(file_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            offset = 0
+            while offset < size:
+                f.seek(offset)
+                header = f.read(OGG_PAGE_HEADER.size)
+                if len(header) < OGG_PAGE_HEADER.size:
+                    break
+                capture, _, _, granule, _, _, _, num_segments = OGG_PAGE_HEADER.unpack(header)
+                if capture != OGG_CAPTURE_PATTERN:
+                    raise ValueError(f"Not an Ogg page at byte {offset} of {file_path}")
+                body_size = sum(f.read(num_segments))
+
+                if sample_rate is None:
+                    # The first page holds the codec identification header
+                    packet = f.read(min(body_size, 19))
+                    if packet.startswith(b"\x01vorbis"):
+                        sample_rate = struct.unpack_from("<I", packet, 12)[0]
+                    elif packet.startswith(b"OpusHead"):
+                        # Opus granules always count 48 kHz samples
+                        sample_rate = 48000
+                        pre_skip = struct.unpack_from("<H", packet, 10)[0]
+                    else:
+                        raise ValueError(f"Unsupported Ogg codec in {file_path}")
+
+                # Header pages have a granule position of 0, audio starts at the first page after.
+                # Pages on which no packet ends have a granule position of -1 and are not
+                # indexed: their bytes belong to the range of the indexed page before them.
+                if granule > 0:
+                    if header_bytes is None:
+                        header_bytes = offset
+                    page_offsets.append(offset)
+                    page_granules.append(granule)
+
+                offset += OGG_PAGE_HEADER.size + num_segments + body_size
+
+        if sample_rate is None:
+            raise ValueError(f"Empty Ogg file: {file_path}")
+
+        return cls(sample_rate, pre_skip, header_bytes or size, page_offsets, page_granules, size)
+
+
+@lru_cache(maxsize=256)
+def _load_index(file_path, mtime, size):
+    """Loads (or builds and persists) the index of a given version of an audio file."""
+    audio_name = os.path.splitext(os.path.basename(file_path))[0]
+    index_path = os.path.join(OGG_INDEX_DIR, f"{audio_name}.json")
+
+    if os.path.exists(index_path):
+        with open(index_path, "r") as f:
+            data = json.load(f)
+        if (
+            data.get("format") == INDEX_FORMAT
+            and data.get("mtime") == mtime
+            and data["index"]["size"] == size
+        ):
+            return OggSeekIndex.from_dict(data["index"])
+
+    index = OggSeekIndex.build(file_path)
+
+    os.makedirs(OGG_INDEX_DIR, exist_ok=True)
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"format": INDEX_FORMAT, "mtime": mtime, "index": index.to_dict()}, f)
+    os.replace(tmp_path, index_path)
+    return index
+
+
+def get_seek_index(filename, audio_dir=AUDIO_DIR):
+    file_path = os.path.join(audio_dir, filename)
+    stat = os.stat(file_path)
+    return _load_index(file_path, stat.st_mtime, stat.st_size)
@@ -0,0 +1,68 @@
+import os
+
+from dummy_server.cache.disk_lru import DiskLRU
+from dummy_server.constants import (
+    AUDIO_DIR,
+    SPECTROGRAM_CACHE_DIR,
+    SPECTROGRAM_CACHE_MAX_BYTES,
+)
+
+SEGMENT_DURATION = 5
+
+
+class SpectrogramImageCache:
+    """Spectrogram images rendered from the audio on first request, kept in a bounded cache."""
+
+    def __init__(
+        self,
+        audio_dir=AUDIO_DIR,
+        cache_dir=SPECTROGRAM_CACHE_DIR,
+        max_bytes=SPECTROGRAM_CACHE_MAX_BYTES,
+        segment_duration=SEGMENT_DURATION,
+    ):
+        self.audio_dir = audio_dir
+        self.segment_duration = segment_duration
+        self.lru = DiskLRU(cache_dir, max_bytes)
+
+    def get_image(self, file_name, segment_id):
+        """Returns the path of the segment's PNG, or None if the audio does not cover it."""
+        audio_path = os.path.join(self.audio_dir, f"{file_name}.ogg")
+        if segment_id < 0 or not os.path.isfile(audio_path):
+            return None
+
+        key = os.path.join(file_name, f"{segment_id}.png")
+        try:
+            return self.lru.get_or_create(
+                key, lambda tmp_path: self._render(audio_path, segment_id, tmp_path)
+            )
+        except IndexError:
+            return None
+
+    def _render(self, audio_path, segment_id, output_path):
+        # Imported here so the web server does not load librosa until an image is missing
+        import librosa as lb
+        from dummy_server.downloader.generate_spectograms import (
+            cyclic_pad,
+            get_log_spectogram,
+        )
+        from dummy_server.downloader.render import render_spectrogram_png
+
+        # Only decode the segment itself, not the whole soundscape
+        y, sr = lb.load(
+            audio_path,
+            sr=None,
+            offset=segment_id * self.segment_duration,
+            duration=self.segment_duration,
+        )
+        if len(y) == 0:
+            raise IndexError(f"Segment {segment_id} is past the end of {audio_path}")
+
+        segment_length = self.segment_duration * sr
+        if len(y) < segment_length:
+            y = cyclic_pad(y, segment_length)
+
+        with open(output_path, "wb") as f:
+            f.write(render_spectrogram_png(get_log_spectogram(y, sr)))
+
+
+spectrogram_cache = SpectrogramImageCache()
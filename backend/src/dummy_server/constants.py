@@ -4,6 +4,17 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "data")
 AUDIO_DIR = os.path.join(DATA_DIR, "audio")
 SPECTROGRAM_DIR = os.path.join(DATA_DIR, "spectrograms")
+FEATURE_DIR = os.path.join(DATA_DIR, "features")
+CACHE_DIR = os.path.join(DATA_DIR, "cache")
+CLIP_CACHE_DIR = os.path.join(CACHE_DIR, "clips")
+OGG_INDEX_DIR = os.path.join(CACHE_DIR, "ogg_index")
+CLIP_CACHE_MAX_BYTES = int(os.getenv("CLIP_CACHE_MAX_MB", "2048")) * 1024 * 1024
+SPECTROGRAM_CACHE_DIR = os.path.join(CACHE_DIR, "spectrograms")
+SPECTROGRAM_CACHE_MAX_BYTES = int(os.getenv("SPECTROGRAM_CACHE_MAX_MB", "1024")) * 1024 * 1024
+# Render spectrogram images on the first request instead of requiring them to be pre-rendered
+SPECTROGRAM_RENDER_ON_MISS = os.getenv("SPECTROGRAM_RENDER_ON_MISS", "1") == "1"
+# Progress of the startup phases, shared by the processes of the production server
+STARTUP_REPORT_PATH = os.path.join(DATA_DIR, "startup.json")
 
 SOFT_LABELS = os.path.join(BASE_DIR, "db", "train_soundscape_labels.csv")
 BIRDS_TO_LABELS = os.path.join(BASE_DIR, "model", "birds_to_labels.json")
@@ -3,13 +3,25 @@ import os
 import random
 from dummy_server.constants import SOFT_LABELS
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timedelta
 import json
 
 from dummy_server import AUDIO_DIR
 
 db = SQLAlchemy()
 
+DB_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), "labels.db")
+
+# Storage tuning, see `engine_options` and `_set_sqlite_pragmas`
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "WAL")
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "30000"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+# Rows per transaction when writing uncertainties back, see `bulk_update_uncertainty`
+UNCERTAINTY_WRITE_CHUNK = int(os.getenv("UNCERTAINTY_WRITE_CHUNK", "5000"))
+
 
 class Audio(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -24,12 +36,26 @@ class Segment(db.Model):
     audio_id = db.Column(db.Integer, db.ForeignKey("audio.id"), nullable=False)
     t_start = db.Column(db.Float, nullable=False)
     labels_json = db.Column(db.Text, nullable=True)
-    uncertainty = db.Column(db.Integer, nullable=True)
+    uncertainty = db.Column(db.Float, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(
         db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow
     )
 
+    __table_args__ = (
+        # The segments of an audio file in time order, so a window is a single range scan
+        # (see `window_segments`)
+        db.Index("ix_segment_audio_t_start", "audio_id", "t_start"),
+        # Partial index over the unlabeled segments, so picking the most uncertain one is a
+        # single index probe (see `most_uncertain_segment`)
+        db.Index(
+            "ix_segment_unlabeled_uncertainty",
+            "uncertainty",
+            sqlite_where=db.text("labels_json IS NULL"),
+            postgresql_where=db.text("labels_json IS NULL"),
+        ),
+    )
+
     @property
     def labels(self):
         return json.loads(self.labels_json) if self.labels_json else None
@@ -48,92 +74,597 @@ class Uncertainty(db.Model):
     value = db.Column(db.Float, nullable=False)
 
 
-def find_audio_filename(id_, location):
+class SegmentLease(db.Model):
+    """Reservation of a segment handed out to an annotator, so it is not handed out twice."""
+
+    segment_id = db.Column(db.Integer, db.ForeignKey("segment.id"), primary_key=True)
+    token = db.Column(db.String, nullable=False, index=True)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+class Meta(db.Model):
+    """Key/value table for database-wide bookkeeping, such as the schema version."""
+
+    key = db.Column(db.String, primary_key=True)
+    value = db.Column(db.Integer, nullable=False)
+
+
+class Job(db.Model):
+    """Work queued by the web server for the model worker (see `dummy_server.model.worker`)."""
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String, nullable=False)
+    # queued -> running -> done | failed
+    state = db.Column(db.String, nullable=False, default="queued", index=True)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Not claimed before this time, so that a burst of requests is debounced into one job
+    run_after = db.Column(db.DateTime, nullable=True)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        # At most one queued job per kind, so concurrent requests coalesce (see `enqueue_job`)
+        db.Index(
+            "ix_job_queued_kind",
+            "kind",
+            unique=True,
+            sqlite_where=db.text("state = 'queued'"),
+            postgresql_where=db.text("state = 'queued'"),
+        ),
+    )
+
+
+# Bump this and register a function in MIGRATIONS for every schema change
+SCHEMA_VERSION = 3
+
+
+def _add_job_run_after():
+    """Version 2: `Job.run_after` and the unique index over queued jobs."""
+    columns = {column["name"] for column in db.inspect(db.engine).get_columns("job")}
+    if "run_after" not in columns:
+        db.session.execute(db.text("ALTER TABLE job ADD COLUMN run_after DATETIME"))
+        db.session.commit()
+    for index in Job.__table__.indexes:
+        index.create(bind=db.engine, checkfirst=True)
+
+
+def _segment_float_uncertainty():
+    """Version 3: `Segment.uncertainty` as a float, and the (audio_id, t_start) index.
+
+    SQLite cannot change the type of a column, so the table is rebuilt under a new name and
+    swapped in. Its indexes are (re)created afterwards.
+    """
+    columns = {column["name"]: column for column in db.inspect(db.engine).get_columns("segment")}
+    if not isinstance(columns["uncertainty"]["type"], db.Float):
+        if db.engine.dialect.name == "sqlite":
+            names = ", ".join(column.name for column in Segment.__table__.columns)
+            values = names.replace("uncertainty", "CAST(uncertainty AS REAL)")
+
+            # Left over by an interrupted migration: the copy was not swapped in yet
+            db.session.execute(db.text("DROP TABLE IF EXISTS segment_new"))
+            metadata = db.MetaData()
+            Audio.__table__.to_metadata(metadata)  # Referenced by the foreign key
+            new_table = Segment.__table__.to_metadata(metadata, name="segment_new")
+            # Index names are global, they are created on the final table below
+            new_table.indexes.clear()
+            new_table.create(bind=db.session.connection())
+
+            db.session.execute(
+                db.text(f"INSERT INTO segment_new ({names}) SELECT {values} FROM segment")
+            )
+            db.session.execute(db.text("DROP TABLE segment"))
+            db.session.execute(db.text("ALTER TABLE segment_new RENAME TO segment"))
+        else:
+            db.session.execute(
+                db.text("ALTER TABLE segment ALTER COLUMN uncertainty TYPE FLOAT")
+            )
+        db.session.commit()
+
+    for index in Segment.__table__.indexes:
+        index.create(bind=db.engine, checkfirst=True)
+
+
+# version -> function upgrading a database from `version - 1` to `version`
+MIGRATIONS = {2: _add_job_run_after, 3: _segment_float_uncertainty}
+
+
+def most_uncertain_segment():
+    """Returns the (id, audio_id, t_start, uncertainty) row of the most uncertain unlabeled
+    segment, or None if every segment is labeled."""
+    return (
+        db.session.query(
+            Segment.id, Segment.audio_id, Segment.t_start, Segment.uncertainty
+        )
+        .filter(Segment.labels_json.is_(None))
+        .order_by(Segment.uncertainty.desc())
+        .first()
+    )
+
+
+def window_segments(audio_id, start, end):
+    """Returns the segments of an audio file starting in [start, end), in time order."""
+    return (
+        Segment.query.filter(
+            Segment.audio_id == audio_id,
+            Segment.t_start >= start,
+            Segment.t_start < end,
+        )
+        .order_by(Segment.t_start)
+        .all()
+    )
+
+
+def unleased_candidates(limit):
+    """Returns up to `limit` (id, audio_id, t_start, uncertainty, filename) rows of the most
+    uncertain unlabeled segments that are not leased to an annotator."""
+    leased = db.session.query(SegmentLease.segment_id).filter(
+        SegmentLease.segment_id == Segment.id
+    )
+    return (
+        db.session.query(
+            Segment.id,
+            Segment.audio_id,
+            Segment.t_start,
+            Segment.uncertainty,
+            Audio.filename,
+        )
+        .join(Audio, Audio.id == Segment.audio_id)
+        .filter(Segment.labels_json.is_(None))
+        .filter(~leased.exists())
+        .order_by(Segment.uncertainty.desc())
+        .limit(limit)
+        .all()
+    )
+
+
+def lease_segments(segment_ids, token, seconds):
+    """Leases the segments to `token`. Raises IntegrityError if one of them is already leased."""
+    expires_at = datetime.utcnow() + timedelta(seconds=seconds)
+    db.session.add_all(
+        SegmentLease(segment_id=segment_id, token=token, expires_at=expires_at)
+        for segment_id in segment_ids
+    )
+    db.session.commit()
+    return expires_at
+
+
+def release_leases(segment_ids=None, token=None, expired=False):
+    """Drops the leases of the given segments, of the given token, and/or the expired ones."""
+    conditions = []
+    if segment_ids is not None:
+        conditions.append(SegmentLease.segment_id.in_(segment_ids))
+    if token is not None:
+        conditions.append(SegmentLease.token == token)
+    if expired:
+        conditions.append(SegmentLease.expires_at <= datetime.utcnow())
+    if not conditions:
+        return 0
+
+    released = SegmentLease.query.filter(db.or_(*conditions)).delete(
+        synchronize_session=False
+    )
+    db.session.commit()
+    return released
+
+
+def bulk_update_uncertainty(segment_ids, values, chunk_size=UNCERTAINTY_WRITE_CHUNK):
+    """Writes uncertainties back with one executemany UPDATE per chunk.
+
+    Each chunk is its own short transaction, so label writes can interleave with a large
+    write-back. Segments that got labeled in the meantime are left alone.
+    """
+    table = Segment.__table__
+    statement = (
+        db.update(table)
+        .where(table.c.id == db.bindparam("segment_id"))
+        .where(table.c.labels_json.is_(None))
+        .values(uncertainty=db.bindparam("value"))
+    )
+
+    for start in range(0, len(segment_ids), chunk_size):
+        db.session.execute(
+            statement,
+            [
+                {"segment_id": int(segment_id), "value": float(value)}
+                for segment_id, value in zip(
+                    segment_ids[start : start + chunk_size],
+                    values[start : start + chunk_size],
+                )
+            ],
+        )
+        db.session.commit()
+
+
+def count_labeled_segments():
+    return Segment.query.filter(Segment.labels_json.isnot(None)).count()
+
+
+def label_segments(labels_by_segment):
+    """Sets the labels of `{segment_id: labels}` in a single transaction. Returns the number of
+    labeled segments and the number of label changes afterwards.
+
+    Both are meta counters, so nobody has to count the labeled segments on every request:
+    `labeled_count` is bumped by the segments that were not labeled before (relabeling a
+    segment does not count twice), and `label_changes` also by the relabeled segments whose
+    labels differ from the stored ones, so that corrections count towards a retrain too.
+    """
+    table = Segment.__table__
+    now = datetime.utcnow()
+    params = [
+        {"segment_id": int(segment_id), "labels": json.dumps(labels), "now": now}
+        for segment_id, labels in labels_by_segment.items()
+    ]
+
+    def statement(condition):
+        return (
+            db.update(table)
+            .where(table.c.id == db.bindparam("segment_id"))
+            .where(condition)
+            .values(
+                labels_json=db.bindparam("labels"),
+                uncertainty=0,
+                updated_at=db.bindparam("now"),
+            )
+        )
+
+    # Relabeled segments first, so that the second statement only matches new labels. Those
+    # submitted again with the same labels are left alone.
+    changed = db.session.execute(
+        statement(
+            table.c.labels_json.isnot(None) & (table.c.labels_json != db.bindparam("labels"))
+        ),
+        params,
+    ).rowcount
+    added = db.session.execute(statement(table.c.labels_json.is_(None)), params).rowcount
+
+    # Counters that are not initialized yet (see `init_db`) start from a count
+    bump_meta("labeled_count", added, count_labeled_segments)
+    bump_meta("label_changes", added + changed, count_labeled_segments)
+
+    # Read through a query, an already loaded `Meta` object would not see the updates
+    values = dict(
+        db.session.execute(
+            db.select(Meta.key, Meta.value).where(
+                Meta.key.in_(["labeled_count", "label_changes"])
+            )
+        ).all()
+    )
+    db.session.commit()
+    return values["labeled_count"], values["label_changes"]
+
+
+def enqueue_job(kind, delay=0, max_delay=None):
+    """Queues a job to run in `delay` seconds. Returns (job id, whether a new job was queued).
+
+    If a job of the same kind is already waiting, the request is coalesced into it and its
+    start is pushed back to `delay` seconds from now, but no later than `max_delay` seconds
+    after it was first queued. A job that was claimed in the meantime does not absorb the
+    request: a new job is queued, so a follow-up always runs after the current one.
+    """
+    while True:
+        now = datetime.utcnow()
+        run_after = now + timedelta(seconds=delay)
+
+        queued = Job.query.filter_by(kind=kind, state="queued").first()
+        if queued is not None:
+            if max_delay is not None:
+                run_after = min(
+                    run_after, queued.created_at + timedelta(seconds=max_delay)
+                )
+            postponed = Job.query.filter_by(id=queued.id, state="queued").update(
+                {"run_after": max(run_after, queued.run_after or now)},
+                synchronize_session=False,
+            )
+            db.session.commit()
+            if postponed:
+                return queued.id, False
+            continue
+
+        job = Job(kind=kind, created_at=now, run_after=run_after)
+        db.session.add(job)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another thread or process queued one first, coalesce into it
+            db.session.rollback()
+            continue
+        return job.id, True
+
+
+def claim_job():
+    """Marks the oldest due queued job as running and returns it, or None if there is none.
+
+    The state check in the UPDATE makes this safe with several workers polling the queue.
+    """
+    while True:
+        job = (
+            Job.query.filter_by(state="queued")
+            .filter(db.or_(Job.run_after.is_(None), Job.run_after <= datetime.utcnow()))
+            .order_by(Job.id)
+            .first()
+        )
+        if job is None:
+            return None
+
+        claimed = Job.query.filter_by(id=job.id, state="queued").update(
+            {"state": "running", "started_at": datetime.utcnow()},
+            synchronize_session=False,
+        )
+        db.session.commit()
+        if claimed:
+            return db.session.get(Job, job.id)
+
+
+def finish_job(job_id, error=None):
+    Job.query.filter_by(id=job_id).update(
+        {
+            "state": "failed" if error else "done",
+            "error": error,
+            "finished_at": datetime.utcnow(),
+        },
+        synchronize_session=False,
+    )
+    db.session.commit()
+
+
+def requeue_running_jobs():
+    """Puts back the jobs a worker was running when it died.
+
+    A job of a kind that already has a queued job is marked as failed instead, since the
+    queued one covers it (and there is at most one queued job per kind).
+    """
+    requeued = 0
+    for job in Job.query.filter_by(state="running").order_by(Job.id).all():
+        if Job.query.filter_by(kind=job.kind, state="queued").first() is None:
+            job.state = "queued"
+            job.started_at = None
+            requeued += 1
+        else:
+            job.state = "failed"
+            job.error = "Interrupted, superseded by a queued job"
+            job.finished_at = datetime.utcnow()
+        db.session.commit()
+    return requeued
+
+
+def count_jobs(state, kind=None):
+    query = Job.query.filter_by(state=state)
+    if kind is not None:
+        query = query.filter_by(kind=kind)
+    return query.count()
+
+
+def get_meta(key, default=None):
+    meta = db.session.get(Meta, key)
+    return meta.value if meta else default
+
+
+def bump_meta(key, amount, initial):
+    """Adds `amount` to a meta counter, in the current transaction. A missing counter is set
+    to `initial()` instead."""
+    counter = db.session.execute(
+        db.update(Meta.__table__).where(Meta.key == key).values(value=Meta.value + amount)
+    )
+    if counter.rowcount == 0:
+        db.session.merge(Meta(key=key, value=initial()))
+
+
+def set_meta(**values):
+    for key, value in values.items():
+        value = int(value)
+        # Update first: the row is only inserted once, and a concurrent insert of the same key
+        # (which `merge` would turn into an IntegrityError) just means we update it instead
+        if Meta.query.filter_by(key=key).update({"value": value}, synchronize_session=False):
+            continue
+        try:
+            with db.session.begin_nested():
+                db.session.add(Meta(key=key, value=value))
+        except IntegrityError:
+            Meta.query.filter_by(key=key).update({"value": value}, synchronize_session=False)
+    db.session.commit()
+
+
+def find_audio_filename(id_, location, audio_files=None):
     prefix = f"{id_}_{location}"
-    for f in os.listdir(AUDIO_DIR):
+    if audio_files is None:
+        audio_files = os.listdir(AUDIO_DIR)
+    for f in audio_files:
         if f.startswith(prefix) and f.endswith(".ogg"):
             return f
     return None
 
 
-def init_db(app):
-    print(">>> Initializing SQLite database...")
-    base_dir = os.path.abspath(os.path.dirname(__file__))
-    db_path = os.path.join(base_dir, "labels.db")
+def get_schema_version():
+    return get_meta("schema_version")
+
+
+def set_schema_version(version):
+    set_meta(schema_version=version)
+
+
+def migrate(version):
+    """Brings a database at schema `version` up to SCHEMA_VERSION."""
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(
+            f"Database schema version {version} is newer than this server ({SCHEMA_VERSION})"
+        )
+
+    while version < SCHEMA_VERSION:
+        version += 1
+        print(f">>> Migrating database schema to version {version}")
+        MIGRATIONS[version]()
+        set_schema_version(version)
 
-    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_path}"
+
+def add_new_audio_files(num_segments=120, segment_duration=5):
+    """Adds the audio files that are not in the database yet, with their segments.
+
+    Rows are inserted with executemany, so a restart only costs O(new files).
+    """
+    known = {filename for (filename,) in db.session.query(Audio.filename)}
+    new_files = sorted(
+        f for f in os.listdir(AUDIO_DIR) if f.endswith(".ogg") and f not in known
+    )
+    if not new_files:
+        print(">>> No new audio files to add.")
+        return 0
+
+    print(f"Processing {len(new_files)} new audio files...")
+    db.session.execute(
+        db.insert(Audio), [{"filename": f, "duration": 500.0} for f in new_files]
+    )
+
+    audio_ids = db.session.query(Audio.id).filter(Audio.filename.in_(new_files))
+    db.session.execute(
+        db.insert(Segment),
+        [
+            {
+                "audio_id": audio_id,
+                "t_start": i * segment_duration,  # Segments: 0, 5, 10, ...
+                "uncertainty": -1.0,
+            }
+            for (audio_id,) in audio_ids
+            for i in range(num_segments)
+        ],
+    )
+    db.session.commit()
+    return len(new_files)
+
+
+def seed_soft_labels(num_labels=20):
+    """Labels random segments based on train_soundscape_labels.csv, for the initial model."""
+    audio_files = [f for f in os.listdir(AUDIO_DIR) if f.endswith(".ogg")]
+
+    label_csv = SOFT_LABELS
+    rows = []
+    with open(label_csv, newline="") as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            labels = row["birds"].split(" ")
+            if not labels or labels == [""]:
+                raise ValueError(
+                    f"Row {row['audio_id']} has no labels. Please check the CSV."
+                )
+
+            audio_filename = find_audio_filename(row["audio_id"], row["site"], audio_files)
+            if audio_filename:
+                row["labels"] = labels if labels != ["nocall"] else []
+                row["audio_filename"] = audio_filename
+                row["t_start"] = (
+                    float(row["seconds"]) - 5
+                )  # in the csv, the time indicates end time
+                rows.append(row)
+
+    if not rows:
+        return
+
+    sampled_rows = random.sample(rows, min(num_labels, len(rows)))
+
+    for row in sampled_rows:
+        audio = Audio.query.filter_by(filename=row["audio_filename"]).first()
+        if not audio:
+            raise ValueError("Corresponding audio not foudn")
+        # Find the segment with matching t_start (approximate float match)
+        segment = Segment.query.filter_by(
+            audio_id=audio.id, t_start=row["t_start"]
+        ).first()
+        if segment:
+            segment.labels = row["labels"]
+            segment.uncertainty = 0  # Or some default value indicating labeled
+
+    db.session.commit()
+    print(
+        f">>> Added {len(sampled_rows)} soft labels for random segments from CSV for initial model."
+    )
+
+
+def engine_options(uri):
+    """SQLAlchemy engine options for the configured database."""
+    options = {
+        # Enough connections for every request thread plus the retrain/scoring threads
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_BUSY_TIMEOUT_MS / 1000,
+    }
+    if uri.startswith("sqlite"):
+        # Connections are handed between threads by the pool, SQLite waits on locks itself
+        options["connect_args"] = {
+            "check_same_thread": False,
+            "timeout": DB_BUSY_TIMEOUT_MS / 1000,
+        }
+    else:
+        options["pool_pre_ping"] = True
+        options["pool_recycle"] = 3600
+    return options
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # WAL lets readers run while the retrain writes, and writers only block each other
+    cursor.execute(f"PRAGMA journal_mode={DB_JOURNAL_MODE}")
+    # NORMAL is durable in WAL mode except against power loss, and avoids an fsync per commit
+    cursor.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
+
+def configure_db(app, uri=None):
+    """Binds `db` to the app, with SQLALCHEMY_DATABASE_URI (env) or the local SQLite file."""
+    if uri is None:
+        uri = os.getenv("SQLALCHEMY_DATABASE_URI", f"sqlite:///{DB_PATH}")
+
+    app.config["SQLALCHEMY_DATABASE_URI"] = uri
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(uri)
     db.init_app(app)
 
+    with app.app_context():
+        if db.engine.dialect.name == "sqlite":
+            db.event.listen(db.engine, "connect", _set_sqlite_pragmas)
+
     print("DB path:", app.config["SQLALCHEMY_DATABASE_URI"])
 
-    # Delete DB if it already exists
-    if os.path.exists(db_path):
-        print("Deleting existing database file:", db_path)
-        os.remove(db_path)
 
-    with app.app_context():
-        db.create_all()
+def init_db(app, reset=None):
+    """Opens (creating or migrating if needed) the database and adds new audio files.
 
-        if Audio.query.count() == 0:
-            audio_files = sorted(os.listdir(AUDIO_DIR))
-            print(f"Processing {len(audio_files)} audio files...")
+    The database persists across restarts. With `reset` (default: the RESET_DB environment
+    variable), it is deleted and rebuilt from scratch instead.
+    """
+    print(">>> Initializing database...")
+    if "sqlalchemy" not in app.extensions:
+        configure_db(app)
 
-            for filename in audio_files:
-                audio = Audio(filename=filename, duration=500.0)
-                db.session.add(audio)
-                db.session.flush()  # So audio.id is available
+    if reset is None:
+        reset = os.getenv("RESET_DB", "0") == "1"
 
-                for i in range(120):  # Segments: 0, 5, 10, ...
-                    seg = Segment(
-                        audio_id=audio.id,
-                        t_start=i * 5,
-                        uncertainty=-1.0,
-                    )
-                    db.session.add(seg)
+    with app.app_context():
+        if reset:
+            print("Dropping existing database:", app.config["SQLALCHEMY_DATABASE_URI"])
+            db.drop_all()
 
-        db.session.commit()
+        # Only creates the tables that do not exist yet
+        db.create_all()
 
-        # Now label 20 random segments based on train_soundscape_labels.csv
-        label_csv = SOFT_LABELS
-        rows = []
-        with open(label_csv, newline="") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                labels = row["birds"].split(" ")
-                if not labels or labels == [""]:
-                    raise ValueError(
-                        f"Row {row['audio_id']} has no labels. Please check the CSV."
-                    )
-
-                audio_filename = find_audio_filename(row["audio_id"], row["site"])
-                if audio_filename:
-                    row["labels"] = labels if labels != ["nocall"] else []
-                    row["audio_filename"] = audio_filename
-                    row["t_start"] = (
-                        float(row["seconds"]) - 5
-                    )  # in the csv, the time indicates end time
-                    rows.append(row)
-
-        if rows:
-            sampled_rows = random.sample(rows, min(20, len(rows)))
-
-            for row in sampled_rows:
-                audio = Audio.query.filter_by(filename=row["audio_filename"]).first()
-                if not audio:
-                    raise ValueError("Corresponding audio not foudn")
-                    continue
-                # Find the segment with matching t_start (approximate float match)
-                segment = Segment.query.filter_by(
-                    audio_id=audio.id, t_start=row["t_start"]
-                ).first()
-                if segment:
-                    segment.labels = row["labels"]
-                    segment.uncertainty = 0  # Or some default value indicating labeled
+        version = get_schema_version()
+        if version is None:
+            # Either a brand new database (create_all just made it at the current schema), or
+            # one from before versioning, which had the version 1 schema
+            version = SCHEMA_VERSION if Audio.query.first() is None else 1
+            set_schema_version(version)
+        migrate(version)
 
-            db.session.commit()
-            print(
-                f">>> Added {len(sampled_rows)} soft labels for random segments from CSV for initial model."
-            )
+        add_new_audio_files()
+
+        if Segment.query.filter(Segment.labels_json.isnot(None)).first() is None:
+            seed_soft_labels()
+
+        # Kept up to date by `label_segments` from now on
+        labeled_count = count_labeled_segments()
+        set_meta(labeled_count=labeled_count)
+        # Never recounted, it also counts relabels. A new database starts from its labels.
+        if get_meta("label_changes") is None:
+            set_meta(label_changes=labeled_count)
 
         print(">>> Tables created and populated with data.")
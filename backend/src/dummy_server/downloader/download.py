@@ -1,75 +1,157 @@
 import os
+import time
+import hashlib
 import zipfile
 import shutil
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 from dummy_server.constants import BIRDS_TO_LABELS, SOFT_LABELS
-from dummy_server import BASE_DIR, DATA_DIR, AUDIO_DIR, SPECTROGRAM_DIR
-
-AUDIO_ZIP_URL = "https://www.dropbox.com/scl/fi/matrf3d0u6knuqslxa5g7/train_soundscapes.zip?rlkey=xp1suommqjsoj11hq2ftq2itd&st=10wpw01g&dl=1"
-SPECTRO_ZIP_URL = "https://www.dropbox.com/scl/fi/o3bvcq32o655ukpphvqaa/spectrograms.zip?rlkey=tsdm2awbkpr54ke2kb10gbeso&st=pl7qb2bw&dl=1"
-
-
-def download_file(url, output_path):
-    response = requests.get(url, stream=True)
-    response.raise_for_status()
-    total_size = int(response.headers.get("content-length", 0))
-    with open(output_path, "wb") as f, tqdm(
-        desc=f"Downloading {os.path.basename(output_path)}",
-        total=total_size,
-        unit="B",
-        unit_scale=True,
-        unit_divisor=1024,
-    ) as bar:
-        for chunk in response.iter_content(chunk_size=8192):
-            if chunk:
-                f.write(chunk)
-                bar.update(len(chunk))
+from dummy_server import DATA_DIR, AUDIO_DIR, SPECTROGRAM_DIR
+
+# Both can be pointed at another host (e.g. a local HTTP server) through the environment
+AUDIO_ZIP_URL = os.getenv(
+    "AUDIO_ZIP_URL",
+    "https://www.dropbox.com/scl/fi/matrf3d0u6knuqslxa5g7/train_soundscapes.zip?rlkey=xp1suommqjsoj11hq2ftq2itd&st=10wpw01g&dl=1",
+)
+SPECTRO_ZIP_URL = os.getenv(
+    "SPECTRO_ZIP_URL",
+    "https://www.dropbox.com/scl/fi/o3bvcq32o655ukpphvqaa/spectrograms.zip?rlkey=tsdm2awbkpr54ke2kb10gbeso&st=pl7qb2bw&dl=1",
+)
+# Optional SHA-256 hex digests the downloaded archives are checked against
+AUDIO_ZIP_SHA256 = os.getenv("AUDIO_ZIP_SHA256")
+SPECTRO_ZIP_SHA256 = os.getenv("SPECTRO_ZIP_SHA256")
+
+CHUNK_SIZE = 64 * 1024
+DOWNLOAD_RETRIES = 5
+
+
+def sha256sum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _download_part(url, part_path):
+    """Appends the rest of `url` to `part_path`, using a Range request if it already exists."""
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+    with requests.get(url, stream=True, headers=headers, timeout=(10, 60)) as response:
+        if offset and response.status_code == 416:
+            # Nothing left to download
+            return
+        response.raise_for_status()
+        if offset and response.status_code != 206:
+            print(f"Server does not support resuming, restarting {os.path.basename(part_path)}")
+            offset = 0
+
+        content_length = int(response.headers.get("content-length", 0))
+        total_size = offset + content_length if content_length else None
+        with open(part_path, "ab" if offset else "wb") as f, tqdm(
+            desc=f"Downloading {os.path.basename(part_path)}",
+            initial=offset,
+            total=total_size,
+            unit="B",
+            unit_scale=True,
+            unit_divisor=1024,
+        ) as bar:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                if chunk:
+                    f.write(chunk)
+                    bar.update(len(chunk))
+
+    if total_size and os.path.getsize(part_path) < total_size:
+        raise requests.ConnectionError(f"Connection closed before the end of {url}")
+
+
+def download_file(url, output_path, sha256=None, retries=DOWNLOAD_RETRIES):
+    """Downloads `url` to `output_path`, resuming interrupted (or previous) partial downloads."""
+    part_path = f"{output_path}.part"
+
+    for attempt in range(1, retries + 1):
+        try:
+            _download_part(url, part_path)
+            break
+        except requests.RequestException as e:
+            if attempt == retries:
+                raise
+            print(f"Download of {os.path.basename(output_path)} interrupted ({e}), resuming...")
+            time.sleep(min(2**attempt, 30))
+
+    if sha256:
+        actual = sha256sum(part_path)
+        if actual != sha256.lower():
+            os.remove(part_path)
+            raise ValueError(
+                f"Checksum mismatch for {os.path.basename(output_path)}: expected {sha256}, got {actual}"
+            )
+
+    os.replace(part_path, output_path)
+
+
+def _extract_member(zip_ref, info, dest_path):
+    """Streams a single member straight to its final location (skipping complete ones)."""
+    if os.path.exists(dest_path) and os.path.getsize(dest_path) == info.file_size:
+        return
+
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    tmp_path = f"{dest_path}.tmp"
+    with zip_ref.open(info) as source, open(tmp_path, "wb") as target:
+        shutil.copyfileobj(source, target, CHUNK_SIZE)
+    os.replace(tmp_path, dest_path)
 
 
 def extract_zip_flat(zip_path, file_ext, target_dir):
-    temp_extract_dir = os.path.join(BASE_DIR, "__temp_extract__")
-    os.makedirs(temp_extract_dir, exist_ok=True)
-
     with zipfile.ZipFile(zip_path, "r") as zip_ref:
-        zip_ref.extractall(temp_extract_dir)
-
-    for root, _, files in os.walk(temp_extract_dir):
-        for fname in tqdm(files, desc=f"Extracting {file_ext}"):
-            if not fname.endswith(file_ext) or fname.startswith("._"):
-                continue
+        members = [
+            info
+            for info in zip_ref.infolist()
+            if not info.is_dir()
+            and info.filename.endswith(file_ext)
+            and not os.path.basename(info.filename).startswith("._")
+        ]
 
-            src = os.path.join(root, fname)
+        for info in tqdm(members, desc=f"Extracting {file_ext}"):
+            fname = os.path.basename(info.filename)
 
             if file_ext == ".png":
-                parts = os.path.relpath(root, temp_extract_dir).split(os.sep)
-                subfolder = parts[-1] if len(parts) else ""
+                subfolder = os.path.basename(os.path.dirname(info.filename))
                 dst_dir = os.path.join(target_dir, subfolder)
             else:
                 dst_dir = target_dir
 
-            os.makedirs(dst_dir, exist_ok=True)
-            dst = os.path.join(dst_dir, fname)
-            shutil.copy2(src, dst)
-
-    shutil.rmtree(temp_extract_dir)
+            _extract_member(zip_ref, info, os.path.join(dst_dir, fname))
 
 
 def extract_zip_preserve_structure(zip_path, target_dir):
     with zipfile.ZipFile(zip_path, "r") as zip_ref:
-        members = zip_ref.namelist()
-        top_level_dir = os.path.commonprefix(members).rstrip("/")
+        members = [info for info in zip_ref.infolist() if not info.is_dir()]
+
+        for info in tqdm(members, desc="Extracting spectrograms"):
+            rel_path = os.path.relpath(info.filename, "spectrograms")
+            _extract_member(zip_ref, info, os.path.join(target_dir, rel_path))
+
+
+def fetch_archive(url, sha256, zip_path, target_dir, extract):
+    """Downloads and extracts an archive into `target_dir`, unless that was already done."""
+    extracted_marker = f"{zip_path}.extracted"
+    has_files = os.path.exists(target_dir) and os.listdir(target_dir)
+    interrupted = os.path.exists(f"{zip_path}.part") or os.path.exists(zip_path)
+
+    if os.path.exists(extracted_marker) or (has_files and not interrupted):
+        print(f"{target_dir} already contains files, skipping download.")
+        return
 
-        for member in members:
-            if member.endswith("/"):
-                continue
-            rel_path = os.path.relpath(member, "spectrograms")
-            dest_path = os.path.join(target_dir, rel_path)
+    if not os.path.exists(zip_path):
+        download_file(url, zip_path, sha256)
+    extract(zip_path, target_dir)
 
-            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-            with zip_ref.open(member) as source, open(dest_path, "wb") as target:
-                shutil.copyfileobj(source, target)
+    # Mark as done only once every member is in place, so an interrupted run resumes
+    open(extracted_marker, "w").close()
 
 
 def download_data():
@@ -87,19 +169,34 @@ def download_data():
     AUDIO_ZIP_PATH = os.path.join(DATA_DIR, "audio.zip")
     SPECTRO_ZIP_PATH = os.path.join(DATA_DIR, "spectrograms.zip")
 
-    if not os.path.exists(AUDIO_DIR) or not os.listdir(AUDIO_DIR):
-        if not os.path.exists(AUDIO_ZIP_PATH):
-            download_file(AUDIO_ZIP_URL, AUDIO_ZIP_PATH)
-        extract_zip_flat(AUDIO_ZIP_PATH, ".ogg", AUDIO_DIR)
-    else:
-        print("Audio directory already contains files, skipping download.")
-
-    if not os.path.exists(SPECTROGRAM_DIR) or not os.listdir(SPECTROGRAM_DIR):
-        if not os.path.exists(SPECTRO_ZIP_PATH):
-            download_file(SPECTRO_ZIP_URL, SPECTRO_ZIP_PATH)
-        extract_zip_preserve_structure(SPECTRO_ZIP_PATH, SPECTROGRAM_DIR)
-    else:
-        print("Spectrogram directory already contains files, skipping download.")
+    # Fetch both archives concurrently, each one is extracted as soon as it is complete
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(
+                fetch_archive,
+                AUDIO_ZIP_URL,
+                AUDIO_ZIP_SHA256,
+                AUDIO_ZIP_PATH,
+                AUDIO_DIR,
+                lambda zip_path, target_dir: extract_zip_flat(zip_path, ".ogg", target_dir),
+            ),
+            executor.submit(
+                fetch_archive,
+                SPECTRO_ZIP_URL,
+                SPECTRO_ZIP_SHA256,
+                SPECTRO_ZIP_PATH,
+                SPECTROGRAM_DIR,
+                extract_zip_preserve_structure,
+            ),
+        ]
+        for future in futures:
+            future.result()
+
+    # The archive ships spectrogram.pt files, the datasets memory-map compact log_mel.npy
+    # (imported here because it needs torch, which the web server does not load otherwise)
+    from dummy_server.model.spectrogram_store import convert_all
+
+    convert_all(SPECTROGRAM_DIR)
 
     # print(
     #     ">>> Skipping soft label and bird label downloads (still using Google Drive constants)."
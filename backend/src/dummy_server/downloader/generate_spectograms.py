@@ -1,6 +1,14 @@
+import argparse
 import os
 import math
 from dummy_server.constants import AUDIO_DIR, SPECTROGRAM_DIR
+from dummy_server.downloader.render import render_spectrogram_png
+from dummy_server.model.spectrogram_store import (
+    SPECTROGRAM_FILENAME,
+    PREVIOUS_SPECTROGRAM_FILENAME,
+    LEGACY_SPECTROGRAM_FILENAME,
+    save_spectrogram,
+)
 import numpy as np
 import torch
 import torchvision.transforms as T
@@ -9,12 +17,11 @@ import matplotlib
 
 matplotlib.use("Agg")  # Non-interactive backend
 import matplotlib.pyplot as plt
-from matplotlib import rcParams
 
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import multiprocessing
-
+import time
 
 def cyclic_pad(y, length):
     n_repeats = length // len(y)
@@ -31,7 +38,52 @@ def get_log_spectogram(y, sr):
     return log_melspec
 
 
-def get_spectograms(audio_file, segment_duration):
+def get_log_spectograms(segments, sr):
+    """Vectorized `get_log_spectogram` over a [num_segments, segment_length] array.
+
+    All segments go through a single (multichannel) STFT and mel projection. The dB conversion
+    is done by hand, because `power_to_db` clips at `top_db` below the maximum of the whole
+    array, while it must be the maximum of each segment.
+    """
+    melspec = lb.feature.melspectrogram(
+        y=segments, sr=sr, n_fft=1024, hop_length=500, n_mels=128, fmin=40, fmax=15000, power=2
+    )  # [num_segments, n_mels, frames]
+    log_melspec = 10.0 * np.log10(np.maximum(melspec, 1e-10))
+    log_melspec = np.maximum(
+        log_melspec, log_melspec.max(axis=(-2, -1), keepdims=True) - 80.0
+    )
+    return log_melspec.astype(np.float32)
+
+
+def split_segments(y, segment_length):
+    """Cuts the signal into [num_segments, segment_length], cyclically padding the last one."""
+    num_segments = math.ceil(len(y) / segment_length)
+    num_full = len(y) // segment_length
+
+    segments = np.empty((num_segments, segment_length), dtype=y.dtype)
+    segments[:num_full] = y[: num_full * segment_length].reshape(num_full, segment_length)
+    if num_full < num_segments:
+        segments[-1] = cyclic_pad(y[num_full * segment_length :], segment_length)
+    return segments
+
+
+def get_spectograms_batched(audio_file, segment_duration):
+    y, sr = lb.load(audio_file, sr=None)
+    segments = split_segments(y, segment_duration * sr)
+
+    log_spectrograms = get_log_spectograms(segments, sr)  # [num_segments, 128, frames]
+
+    images = torch.from_numpy(log_spectrograms).unsqueeze(1)  # [num_segments, 1, 128, frames]
+    # Single channel, in dB: the channels are expanded and normalized when loaded
+    images = T.Resize((224, 224))(images).squeeze(1)  # [num_segments, 224, 224]
+
+    return images, list(log_spectrograms), sr
+
+
+def get_spectograms(audio_file, segment_duration, batched=True):
+    if batched:
+        return get_spectograms_batched(audio_file, segment_duration)
+
     y, sr = lb.load(audio_file, sr=None)
     segment_length = segment_duration * sr
     num_segments = math.ceil(len(y) / segment_length)
@@ -40,8 +92,7 @@ def get_spectograms(audio_file, segment_duration):
         [
             T.ToTensor(),
             T.Resize((224, 224)),
-            T.Lambda(lambda x: x.repeat(3, 1, 1)),
-            T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+            T.Lambda(lambda x: x.squeeze(0)),
         ]
     )
 
@@ -65,44 +116,97 @@ def get_spectograms(audio_file, segment_duration):
     return torch.stack(spectograms), raw_specs, sr
 
 
-def process_audio_file(audio_file, audio_path, spectrogram_path, segment_duration):
+def render_with_matplotlib(raw_spec, image_path, segment_duration):
+    """Full figure with axes and colorbar (slow, see `render.render_spectrogram_png`)."""
+    plt.figure(figsize=(6, 4))
+    img = plt.imshow(
+        raw_spec,
+        origin="lower",
+        aspect="auto",
+        extent=[0, segment_duration, 40, 15000],
+        cmap="magma",
+        vmin=-60,
+        vmax=20,
+    )
+    plt.colorbar(img, format="%+2.0f dB")
+
+    plt.xlabel("Time (s)")
+    plt.ylabel("Frequency (Hz)")
+    plt.xticks(np.linspace(0, segment_duration, 6))
+    plt.yticks()
+
+    plt.savefig(image_path, dpi=100, transparent=True)
+    plt.close()
+
+
+def process_audio_file(
+    audio_file,
+    audio_path,
+    spectrogram_path,
+    segment_duration,
+    batched=True,
+    renderer="fast",
+):
     audio_file_path = os.path.join(audio_path, audio_file)
     file_base_name = os.path.splitext(audio_file)[0]
     output_dir = os.path.join(spectrogram_path, file_base_name)
 
-    if os.path.exists(os.path.join(output_dir, "spectrogram.pt")):
+    if any(
+        os.path.exists(os.path.join(output_dir, filename))
+        for filename in (
+            SPECTROGRAM_FILENAME,
+            PREVIOUS_SPECTROGRAM_FILENAME,
+            LEGACY_SPECTROGRAM_FILENAME,
+        )
+    ):
         return f"{audio_file} already processed, skipping."
 
-    spectograms, raw_specs, sr = get_spectograms(audio_file_path, segment_duration)
+    spectograms, raw_specs, sr = get_spectograms(
+        audio_file_path, segment_duration, batched=batched
+    )
     os.makedirs(output_dir, exist_ok=True)
 
-    torch.save(spectograms, os.path.join(output_dir, "spectrogram.pt"))
+    save_spectrogram(os.path.join(output_dir, SPECTROGRAM_FILENAME), spectograms.numpy())
+
+    if renderer == "none":
+        return f"Saved spectrogram for {audio_file}"
 
     for idx, raw_spec in enumerate(raw_specs):
-        plt.figure(figsize=(6, 4))
-        img = plt.imshow(
-            raw_spec,
-            origin="lower",
-            aspect="auto",
-            extent=[0, segment_duration, 40, 15000],
-            cmap="magma",
-            vmin=-60,
-            vmax=20,
-        )
-        plt.colorbar(img, format="%+2.0f dB")
+        image_path = os.path.join(output_dir, f"{idx}.png")
+        if renderer == "fast":
+            with open(image_path, "wb") as f:
+                f.write(render_spectrogram_png(raw_spec))
+        else:
+            render_with_matplotlib(raw_spec, image_path, segment_duration)
 
-        plt.xlabel("Time (s)")
-        plt.ylabel("Frequency (Hz)")
-        plt.xticks(np.linspace(0, segment_duration, 6))
-        plt.yticks()
+    return f"Saved spectrogram and images for {audio_file}"
 
-        plt.savefig(os.path.join(output_dir, f"{idx}.png"), dpi=100, transparent=True)
-        plt.close()
 
-    return f"Saved spectrogram and images for {audio_file}"
+def _init_worker():
+    # Each worker process handles one file at a time, so avoid oversubscribing the cores
+    torch.set_num_threads(1)
 
 
-def generate_spectrograms(audio_path, spectrogram_path, segment_duration=5):
+def generate_spectrograms(
+    audio_path,
+    spectrogram_path,
+    segment_duration=5,
+    executor="process",
+    num_workers=None,
+    batched=True,
+    renderer="fast",
+):
+    """Generates the spectrograms of every audio file that has not been processed yet.
+
+    `executor="process"` spreads files over one process per core (librosa and matplotlib
+    mostly hold the GIL); `executor="thread"` keeps the previous thread pool behaviour.
+    `renderer="fast"` writes the PNGs with a vectorized colormap lookup and no axes;
+    `renderer="matplotlib"` draws the full figures with axes and colorbar.
+    `renderer="none"` skips the images, the server then renders them on first request.
+    """
+    if renderer not in ("fast", "matplotlib", "none"):
+        raise ValueError(f"Unknown renderer: {renderer}")
+
     print(">>> Generating spectrograms if not present...")
 
     if not os.path.exists(audio_path):
@@ -110,33 +214,70 @@ def generate_spectrograms(audio_path, spectrogram_path, segment_duration=5):
     os.makedirs(spectrogram_path, exist_ok=True)
 
     audio_files = [f for f in os.listdir(audio_path) if f.endswith(".ogg")]
-    num_threads = min(4, multiprocessing.cpu_count() or 1)
-
-    print(">>> Using {} threads for processing.".format(num_threads))
 
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+    if executor == "process":
+        num_workers = num_workers or multiprocessing.cpu_count() or 1
+        pool = ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker)
+        print(">>> Using {} processes for processing.".format(num_workers))
+    elif executor == "thread":
+        num_workers = num_workers or min(4, multiprocessing.cpu_count() or 1)
+        pool = ThreadPoolExecutor(max_workers=num_workers)
+        print(">>> Using {} threads for processing.".format(num_workers))
+    else:
+        raise ValueError(f"Unknown executor: {executor}")
+
+    start_time = time.perf_counter()
+    with pool:
         futures = {
-            executor.submit(
+            pool.submit(
                 process_audio_file,
                 audio_file,
                 audio_path,
                 spectrogram_path,
                 segment_duration,
+                batched,
+                renderer,
             ): audio_file
             for audio_file in audio_files
         }
 
-        for future in tqdm(
+        with tqdm(
             as_completed(futures), total=len(futures), desc="Processing files"
-        ):
-            result = future.result()
-            tqdm.write(f"{result}")
-
-    print(">>> Spectrogram generation complete.")
+        ) as bar:
+            for done, future in enumerate(bar, start=1):
+                result = future.result()
+                tqdm.write(f"{result}")
+                bar.set_postfix(
+                    files_per_sec=f"{done / (time.perf_counter() - start_time):.2f}"
+                )
+
+    elapsed = time.perf_counter() - start_time
+    print(
+        f">>> Spectrogram generation complete: {len(audio_files)} files in {elapsed:.1f}s "
+        f"({len(audio_files) / max(elapsed, 1e-9):.2f} files/sec)."
+    )
 
 
 if __name__ == "__main__":
-    audio_path = AUDIO_DIR
-    spectrogram_path = SPECTROGRAM_DIR
-
-    generate_spectrograms(audio_path, spectrogram_path, segment_duration=5)
+    parser = argparse.ArgumentParser(description="Generate spectrograms for all audio files.")
+    parser.add_argument("--executor", choices=["process", "thread"], default="process")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--per-segment",
+        action="store_true",
+        help="Compute the mel spectrogram of each segment separately (previous behaviour)",
+    )
+    parser.add_argument(
+        "--renderer", choices=["fast", "matplotlib", "none"], default="fast"
+    )
+    args = parser.parse_args()
+
+    generate_spectrograms(
+        AUDIO_DIR,
+        SPECTROGRAM_DIR,
+        segment_duration=5,
+        executor=args.executor,
+        num_workers=args.workers,
+        batched=not args.per_segment,
+        renderer=args.renderer,
+    )
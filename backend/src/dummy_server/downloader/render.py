@@ -0,0 +1,77 @@
+import struct
+import zlib
+from functools import lru_cache
+
+import numpy as np
+
+# Same scale as the matplotlib figures: magma colormap over [-60, 20] dB
+DEFAULT_CMAP = "magma"
+DEFAULT_VMIN = -60.0
+DEFAULT_VMAX = 20.0
+DEFAULT_SIZE = (600, 400)  # (width, height), the size of the 6x4 inch figures at 100 dpi
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+@lru_cache(maxsize=None)
+def colormap_lut(name=DEFAULT_CMAP):
+    """[256, 3] uint8 lookup table of a matplotlib colormap (no figure involved)."""
+    from matplotlib import colormaps
+
+    colors = colormaps[name](np.linspace(0.0, 1.0, 256))[:, :3]
+    return np.round(colors * 255).astype(np.uint8)
+
+
+def colorize(db, vmin=DEFAULT_VMIN, vmax=DEFAULT_VMAX, cmap=DEFAULT_CMAP):
+    """Maps a 2D dB array to [H, W, 3] RGB, binning like matplotlib's Normalize + Colormap."""
+    norm = (np.asarray(db, dtype=np.float32) - vmin) / (vmax - vmin)
+    indices = np.clip((norm * 256).astype(np.int32), 0, 255)
+    return colormap_lut(cmap)[indices]
+
+
+def encode_png(rgb, compress_level=6):
+    """Encodes a [H, W, 3] uint8 array as an 8-bit RGB PNG."""
+    height, width, _ = rgb.shape
+
+    # Every scanline starts with its filter type, 0 (None)
+    raw = np.empty((height, 1 + width * 3), dtype=np.uint8)
+    raw[:, 0] = 0
+    raw[:, 1:] = rgb.reshape(height, width * 3)
+
+    def chunk(tag, data):
+        return (
+            struct.pack(">I", len(data))
+            + tag
+            + data
+            + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+        )
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (
+        PNG_SIGNATURE
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(raw.tobytes(), compress_level))
+        + chunk(b"IEND", b"")
+    )
+
+
+def render_spectrogram_png(
+    raw_spec,
+    size=DEFAULT_SIZE,
+    vmin=DEFAULT_VMIN,
+    vmax=DEFAULT_VMAX,
+    cmap=DEFAULT_CMAP,
+):
+    """Renders a [n_mels, frames] dB spectrogram to PNG bytes, without axes or colorbar.
+
+    Low frequencies are at the bottom (`origin="lower"`), and the image is stretched to `size`
+    with nearest-neighbour sampling, like `imshow(aspect="auto")`.
+    """
+    width, height = size
+    n_mels, frames = raw_spec.shape
+
+    rows = (np.arange(height) * n_mels // height)[::-1]
+    cols = np.arange(width) * frames // width
+    resized = np.asarray(raw_spec)[rows[:, None], cols[None, :]]
+
+    return encode_png(colorize(resized, vmin, vmax, cmap))
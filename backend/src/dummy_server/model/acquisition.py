@@ -0,0 +1,36 @@
+import numpy as np
+
+
+def select_batch(scores, embeddings, k, diversity=0.5):
+    """Greedily picks `k` candidates, trading off their BALD score against diversity.
+
+    The first pick is the most uncertain candidate. Every next pick maximizes a mix of its
+    (min-max normalized) score and its cosine distance to the closest candidate already picked,
+    so a batch does not end up with k near-duplicates of the same call. Without embeddings this
+    falls back to the top-k scores. Returns indices into `scores`.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    k = min(k, len(scores))
+    if k == 0:
+        return []
+    if embeddings is None:
+        return [int(i) for i in np.argsort(-scores, kind="stable")[:k]]
+
+    span = scores.max() - scores.min()
+    norm_scores = (scores - scores.min()) / span if span > 0 else np.ones_like(scores)
+
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    embeddings = embeddings / np.maximum(
+        np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12
+    )
+
+    selected = [int(np.argmax(scores))]
+    min_dist = 1.0 - embeddings @ embeddings[selected[0]]  # cosine distance, in [0, 2]
+    while len(selected) < k:
+        gain = (1.0 - diversity) * norm_scores + diversity * min_dist / 2.0
+        gain[selected] = -np.inf
+        best = int(np.argmax(gain))
+        selected.append(best)
+        min_dist = np.minimum(min_dist, 1.0 - embeddings @ embeddings[best])
+
+    return selected
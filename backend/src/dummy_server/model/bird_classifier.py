@@ -1,10 +1,70 @@
+import os
+
 from dummy_server.constants import MODEL_PATH
+from dummy_server.model.feature_store import BACKBONE_NAME, backbone_version
 import torch
 import torch.nn as nn
 import timm
 
 NUM_CLASSES = 398
 
+# Optional MC-dropout speedups: "bfloat16" runs the head under autocast, and
+# MC_DROPOUT_COMPILE=1 compiles the sampling with torch.compile (slow first call)
+MC_DROPOUT_DTYPE = os.getenv("MC_DROPOUT_DTYPE", "float32")
+MC_DROPOUT_COMPILE = os.getenv("MC_DROPOUT_COMPILE", "0") == "1"
+
+
+def make_head(in_features, num_classes):
+    return nn.Sequential(
+        nn.Linear(in_features=in_features, out_features=1024),  # First hidden layer
+        nn.ReLU(),
+        nn.Dropout(0.5),
+        nn.Linear(1024, 512),  # Second hidden layer
+        nn.ReLU(),
+        nn.Dropout(0.5),
+        nn.Linear(512, num_classes),  # Output layer (387 classes)
+    )
+
+
+def mc_dropout_logits(head, pooled, num_preds):
+    """Logits of `num_preds` dropout samples of the head, as [num_preds, batch_size, num_classes].
+
+    The layers before the first dropout are deterministic, so they run once on the
+    un-repeated features. From there on the activations get a leading sample dimension and
+    every Dropout draws the masks of all samples at once, whatever mode the head is in.
+    """
+    x = pooled
+    sampled = False
+    for layer in head:
+        if isinstance(layer, nn.Dropout):
+            if not sampled:
+                x = x.unsqueeze(0).expand(num_preds, *x.shape)
+                sampled = True
+            keep = 1.0 - layer.p
+            x = x * torch.empty_like(x).bernoulli_(keep).div_(keep)
+        else:
+            x = layer(x)
+
+    if not sampled:
+        x = x.unsqueeze(0).expand(num_preds, *x.shape)
+    return x
+
+
+def bald(probs):
+    """Mutual information (BALD) and predictive entropy of [num_preds, batch_size, num_classes]
+    sampled probabilities."""
+    probs_mean = probs.mean(dim=0)  # [batch_size, num_classes]
+    predictive_entropy = -torch.sum(
+        probs_mean * torch.log(probs_mean + 1e-8), dim=-1
+    )  # [batch_size]
+
+    entropy_per_sample = -torch.sum(
+        probs * torch.log(probs + 1e-8), dim=-1
+    )  # [N, batch_size]
+    model_entropy = entropy_per_sample.mean(dim=0)  # [batch_size]
+
+    return predictive_entropy - model_entropy, predictive_entropy
+
 
 class Model(nn.Module):
     def __init__(self, num_classes=NUM_CLASSES):
@@ -13,7 +73,7 @@ class Model(nn.Module):
         self.num_classes = num_classes
 
         # TODO: Load pre-trained full model here (efficientnet + fc layer trained on the training data)
-        self._model = timm.create_model("efficientnet_b0", pretrained=True)
+        self._model = timm.create_model(BACKBONE_NAME, pretrained=True)
 
         # Freeze the base model (optional) - we only train the last MLP layers for new samples
         for param in self._model.parameters():
@@ -21,74 +81,102 @@ class Model(nn.Module):
 
         # Replace the final classifier layer with one for multi-label classification
         # NOTE: These params are not frozen
-        self._model.classifier = nn.Sequential(
-            nn.Linear(
-                in_features=self._model.classifier.in_features, out_features=1024
-            ),  # First hidden layer
-            nn.ReLU(),
-            nn.Dropout(0.5),
-            nn.Linear(1024, 512),  # Second hidden layer
-            nn.ReLU(),
-            nn.Dropout(0.5),
-            nn.Linear(512, self.num_classes),  # Output layer (387 classes)
+        self._model.classifier = make_head(
+            self._model.classifier.in_features, self.num_classes
         )
+        self._mc_dropout_logits = (
+            torch.compile(mc_dropout_logits) if MC_DROPOUT_COMPILE else mc_dropout_logits
+        )
+
+    @property
+    def backbone_version(self):
+        return backbone_version()
 
     def forward(self, x):
         return self._model(x)
 
-    def get_uncertainty(self, probs):
-        # Approach 1: BALD
-        probs_mean = probs.mean(dim=0)  # [batch_size, num_classes]
-        predictive_entropy = -torch.sum(
-            probs_mean * torch.log(probs_mean + 1e-8), dim=-1
-        )  # [batch_size]
+    def embed(self, x):
+        """Pooled backbone features, i.e. the input of the classifier head."""
+        features = self._model.forward_features(x)
+        return self._model.global_pool(features)  # (batch_size, classifier_in)
+
+    def head(self, pooled):
+        return self._model.classifier(pooled)
 
-        entropy_per_sample = -torch.sum(
-            probs * torch.log(probs + 1e-8), dim=-1
-        )  # [N, batch_size]
-        model_entropy = entropy_per_sample.mean(dim=0)  # [batch_size]
+    def classifier_state_dict(self):
+        return self._model.classifier.state_dict()
 
-        mutual_information = predictive_entropy - model_entropy
+    def load_classifier_state_dict(self, state_dict):
+        self._model.classifier.load_state_dict(state_dict)
 
+    def get_uncertainty(self, probs):
+        # Approach 1: BALD
         # TODO (?): Other approaches (e.g. first min over the num_preds, then total entropy), total_entropy with just 1 pred
-        return mutual_information, predictive_entropy
+        return bald(probs)
 
     def inference(self, x, num_preds=10):
         """Inference function that returns probabilities and uncertainty."""
         # Assumes x has shape (batch_size, channels, height, width) (even for batch size 1)
 
-        # Set to train so droupout still works (so we get random outputs)
-        self.train()
+        # Dropout masks are sampled explicitly, so the backbone can stay in eval mode
+        self.eval()
 
         # Pass the input through the EfficientNet feature extractor once (for efficiency), not the classification head
-        features = self._model.forward_features(x)
-        pooled = self._model.global_pool(features)  # (batch_size, classifier_in)
-
-        # Run through classifier head N times
-        pooled_repeated = pooled.unsqueeze(0).repeat(
-            num_preds, 1, 1
-        )  # (num_samples, batch_size, classifier_in)
-        pooled_repeated = pooled_repeated.view(
-            -1, *pooled.size()[1:]
-        )  # Flatten to (num_samples * batch_size, ...)
-        logits = self._model.classifier(pooled_repeated)
-        probs = torch.sigmoid(logits)
-        probs = probs.view(
-            num_preds, -1, self.num_classes
-        )  # Reshape back to (num_samples, batch_size, num_classes)
+        return self.inference_from_features(self.embed(x), num_preds=num_preds)
+
+    def inference_from_features(self, pooled, num_preds=10):
+        """Same as `inference`, but starting from (cached) pooled backbone features.
+
+        Returns the mean probabilities, the mutual information and the predictive entropy.
+        """
+        with torch.autocast(
+            device_type=pooled.device.type,
+            dtype=torch.bfloat16,
+            enabled=MC_DROPOUT_DTYPE == "bfloat16",
+        ):
+            logits = self._mc_dropout_logits(self._model.classifier, pooled, num_preds)
+        probs = torch.sigmoid(logits.float())  # (num_samples, batch_size, num_classes)
 
         assert probs.shape[0] == num_preds
-        assert probs.shape[1] == x.shape[0]  # batch_size
+        assert probs.shape[1] == pooled.shape[0]  # batch_size
         assert probs.shape[2] == self.num_classes
 
         # For final prediction, take min/mean across all dimensions (min to reduce uncertainty) - but maybe don't even need this
         # TODO (possibly): already introduce thresholding here for outputting just bird class labels
-        return (
-            probs.mean(dim=0),
-            self.get_uncertainty(probs)[0],
-            self.get_uncertainty(probs)[1],
-        )
-
-    def save(self, path=MODEL_PATH):
+        mutual_information, predictive_entropy = self.get_uncertainty(probs)
+        return probs.mean(dim=0), mutual_information, predictive_entropy
+
+    def save(self, path=MODEL_PATH, trained_labels=()):
+        """Saves the classifier head (the backbone is the pretrained one) and the
+        (segment id, label hash) pairs it was trained on."""
+        checkpoint = {
+            "backbone_version": self.backbone_version,
+            "classifier": self.classifier_state_dict(),
+            "trained_labels": [
+                [int(segment_id), int(label_hash)] for segment_id, label_hash in trained_labels
+            ],
+        }
+        tmp_path = f"{path}.tmp"
+        torch.save(checkpoint, tmp_path)
+        os.replace(tmp_path, path)
         print("Saved model to ", path)
-        torch.save(self.state_dict(), path)
+
+    def load(self, path=MODEL_PATH):
+        """Loads the head saved by `save`. Returns the (segment id, label hash) pairs it was
+        trained on, or None if there is no usable checkpoint."""
+        if not os.path.exists(path):
+            return None
+
+        checkpoint = torch.load(path, map_location="cpu")
+        if "classifier" not in checkpoint:
+            # Full state dict written by earlier versions, which did not record its labels
+            self.load_state_dict(checkpoint)
+            return set()
+        if checkpoint["backbone_version"] != self.backbone_version:
+            print(f">>> Ignoring checkpoint trained on {checkpoint['backbone_version']}")
+            return None
+
+        self.load_classifier_state_dict(checkpoint["classifier"])
+        # Checkpoints with bare segment ids do not tell relabeled segments apart, every label
+        # is then treated as new once
+        return {tuple(pair) for pair in checkpoint.get("trained_labels", ())}
@@ -1,102 +1,146 @@
 import os
 import json
+import zlib
 import torch
 import numpy as np
 from torch.utils.data import Dataset
 from dummy_server.db.sqlite import Audio, Segment
+from dummy_server.model import spectrogram_store
+
+SEGMENT_DURATION = 5
+
+
+def load_segment(spect_path, segment_index, feature_store=None):
+    """Loads a segment spectrogram, or its cached backbone features if a store is given."""
+    if feature_store is not None:
+        audio_name = os.path.basename(os.path.dirname(spect_path))
+        features = feature_store.load(audio_name)
+        return torch.from_numpy(np.array(features[segment_index]))  # [classifier_in]
+
+    return spectrogram_store.load_segment(spect_path, segment_index)  # [3, 224, 224]
+
+
+class SegmentIndex:
+    """Compact, picklable index of segments built from a single joined query.
+
+    Each segment is a row of three arrays: its id, the index of its audio file in
+    `spect_paths` and its segment index within that file. The spectrogram path of every
+    audio file is resolved (and checked) once, not once per segment.
+    """
+
+    def __init__(self, rows, spectrogram_dir):
+        self.spect_paths = []
+        audio_indices = {}  # filename -> index in spect_paths
+
+        segment_ids = []
+        audio_index = []
+        segment_index = []
+        for segment_id, t_start, filename in rows:
+            if filename not in audio_indices:
+                audio_name = os.path.splitext(filename)[0]
+                audio_indices[filename] = len(self.spect_paths)
+                self.spect_paths.append(
+                    spectrogram_store.convert_spectrogram(spectrogram_dir, audio_name)
+                )
+
+            segment_ids.append(segment_id)
+            audio_index.append(audio_indices[filename])
+            segment_index.append(int(t_start // SEGMENT_DURATION))
+
+        self.segment_ids = np.array(segment_ids, dtype=np.int64)
+        self.audio_index = np.array(audio_index, dtype=np.int32)
+        self.segment_index = np.array(segment_index, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.segment_ids)
+
+    def location(self, idx):
+        """Returns (spect_path, segment_index) of the idx-th segment."""
+        return self.spect_paths[self.audio_index[idx]], int(self.segment_index[idx])
+
+
+def segment_rows(db_session, *columns):
+    """Query of (segment id, t_start, audio filename, *columns) rows, without ORM objects."""
+    return db_session.query(
+        Segment.id, Segment.t_start, Audio.filename, *columns
+    ).join(Audio, Segment.audio_id == Audio.id)
 
 
 class LabeledSegmentDataset(Dataset):
     """Dataset for segments with labels."""
 
-    def __init__(self, db_session, spectrogram_dir, birds_to_labels_path):
+    def __init__(
+        self, db_session, spectrogram_dir, birds_to_labels_path, feature_store=None
+    ):
         self.spectrogram_dir = spectrogram_dir
+        self.feature_store = feature_store
 
         # Load mapping once
         with open(birds_to_labels_path, "r") as f:
             self.birds_to_labels = json.load(f)
 
         self.num_classes = len(self.birds_to_labels)
-        self.samples = []  # list of tuples: (spect_path, segment_index, label_tensor)
 
         # Fetch all labeled segments and cache info (no DB session kept)
-        audios = db_session.query(Audio).all()
-        for audio in audios:
-            audio_name = os.path.splitext(audio.filename)[0]
-            spect_path = os.path.join(
-                self.spectrogram_dir, audio_name, "spectrogram.pt"
-            )
-
-            if not os.path.exists(spect_path):
-                raise FileNotFoundError(f"Spectrogram file not found: {spect_path}")
-
-            segments = (
-                db_session.query(Segment)
-                .filter(Segment.audio_id == audio.id)
-                .order_by(Segment.t_start)
-                .all()
-            )
-
-            for i, segment in enumerate(segments):
-                if segment.labels is None:
-                    continue
-
-                label_tensor = torch.zeros(self.num_classes)
-                for label in segment.labels:
-                    if label in self.birds_to_labels:
-                        label_tensor[self.birds_to_labels[label]] = 1.0
-                    else:
-                        raise ValueError(
-                            f"Label '{label}' not found in birds_to_labels mapping."
-                        )
-
-                self.samples.append((spect_path, i, label_tensor))
+        rows = (
+            segment_rows(db_session, Segment.labels_json)
+            .filter(Segment.labels_json.isnot(None))
+            .order_by(Audio.id, Segment.t_start)
+            .all()
+        )
+        self.index = SegmentIndex((row[:3] for row in rows), spectrogram_dir)
+        # Identifies the version of each segment's labels, so a relabeled segment is new again
+        self.label_hashes = np.array(
+            [zlib.crc32(row.labels_json.encode()) for row in rows], dtype=np.int64
+        )
+
+        # Multi-hot labels, one row per segment
+        self.labels = np.zeros((len(rows), self.num_classes), dtype=np.float32)
+        for i, row in enumerate(rows):
+            for label in json.loads(row.labels_json):
+                if label not in self.birds_to_labels:
+                    raise ValueError(
+                        f"Label '{label}' not found in birds_to_labels mapping."
+                    )
+                self.labels[i, self.birds_to_labels[label]] = 1.0
 
     def __len__(self):
-        return len(self.samples)
+        return len(self.index)
 
     def __getitem__(self, idx):
-        spect_path, segment_index, label_tensor = self.samples[idx]
-        full_spect = torch.load(spect_path)  # [120, 3, 224, 224]
-        segment = full_spect[segment_index]  # [3, 224, 224]
-        return segment, label_tensor
+        spect_path, segment_index = self.index.location(idx)
+        segment = load_segment(spect_path, segment_index, self.feature_store)
+        return segment, torch.from_numpy(self.labels[idx])
 
 
 class AllSegmentDataset(Dataset):
-    """Dataset for all segments, regardless of labels."""
+    """Dataset for all segments, regardless of labels.
 
-    def __init__(self, db_session, spectrogram_dir):
-        self.spectrogram_dir = spectrogram_dir
+    With `unlabeled_only`, labeled segments are skipped and the remaining ones are ordered from
+    most to least uncertain (according to the previous model), so the current query candidates
+    come first. Items are `(segment, segment_id)`.
+    """
 
-        self.samples = []  # tuples: (spect_path, segment_index, segment_obj)
+    def __init__(
+        self, db_session, spectrogram_dir, feature_store=None, unlabeled_only=False
+    ):
+        self.spectrogram_dir = spectrogram_dir
+        self.feature_store = feature_store
 
         # Cache all segments info (no DB session kept)
-        segments = db_session.query(Segment).order_by(Segment.id).all()
-        for seg in segments:
-            audio = db_session.query(Audio).get(seg.audio_id)
-            if not audio:
-                raise ValueError(
-                    f"Audio with ID {seg.audio_id} not found for segment {seg.id}."
-                )
-                continue
-
-            audio_name = os.path.splitext(audio.filename)[0]
-            spect_path = os.path.join(spectrogram_dir, audio_name, "spectrogram.pt")
-
-            if not os.path.exists(spect_path):
-                raise FileNotFoundError(
-                    f"Spectrogram file not found: {spect_path} for segment {seg.id}."
-                )
-                continue
-
-            segment_index = int(seg.t_start / 5)
-            self.samples.append((spect_path, segment_index, seg))
+        query = segment_rows(db_session)
+        if unlabeled_only:
+            query = query.filter(Segment.labels_json.is_(None)).order_by(
+                Segment.uncertainty.desc(), Segment.id
+            )
+        else:
+            query = query.order_by(Segment.id)
+        self.index = SegmentIndex(query.all(), spectrogram_dir)
 
     def __len__(self):
-        return len(self.samples)
+        return len(self.index)
 
     def __getitem__(self, idx):
-        spect_path, segment_index, segment_obj = self.samples[idx]
-        full_spect = torch.load(spect_path)  # [120, 3, 224, 224]
-        segment = full_spect[segment_index]  # [3, 224, 224]
-        return segment, segment_obj
+        spect_path, segment_index = self.index.location(idx)
+        segment = load_segment(spect_path, segment_index, self.feature_store)
+        return segment, int(self.index.segment_ids[idx])
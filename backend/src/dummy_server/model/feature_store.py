@@ -0,0 +1,87 @@
+import os
+from functools import lru_cache
+from importlib.metadata import version
+
+import numpy as np
+from tqdm import tqdm
+
+from dummy_server.constants import FEATURE_DIR
+
+BACKBONE_NAME = "efficientnet_b0"
+
+
+def backbone_version():
+    """Identifies the frozen backbone, so cached features can be invalidated."""
+    # Read from the package metadata, so the web server does not have to import timm
+    return f"{BACKBONE_NAME}-timm{version('timm')}"
+
+
+@lru_cache(maxsize=1024)
+def open_features(path):
+    """Memory-maps a feature file once per process (the path includes the backbone version);
+    indexing a single segment only reads that row. The arrays are small, so the cache can
+    hold every audio file."""
+    return np.load(path, mmap_mode="r")
+
+
+class FeatureStore:
+    """On-disk cache of pooled backbone features.
+
+    The backbone is frozen, so the input of the classifier head never changes for a given
+    segment. We keep one `[num_segments, classifier_in]` float32 array per audio file, under a
+    directory named after the backbone version so that a new backbone starts a fresh cache.
+    """
+
+    def __init__(self, version, feature_dir=FEATURE_DIR):
+        self.version = version
+        self.root = os.path.join(feature_dir, version)
+
+    def path(self, audio_name):
+        return os.path.join(self.root, f"{audio_name}.npy")
+
+    def has(self, audio_name):
+        return os.path.exists(self.path(audio_name))
+
+    def load(self, audio_name):
+        return open_features(self.path(audio_name))
+
+    def build(self, model, spectrogram_dir, audio_names, device, batch_size=16):
+        """Compute and store the features of every audio file that is not cached yet."""
+        # Only the model worker builds features, the web server merely reads them
+        import torch
+        from dummy_server.model import spectrogram_store
+
+        missing = [name for name in audio_names if not self.has(name)]
+        if not missing:
+            print(f">>> Backbone features up to date ({self.version})")
+            return 0
+
+        os.makedirs(self.root, exist_ok=True)
+
+        # Eval mode so the cached features do not depend on the batch they were computed in
+        model.eval()
+        with torch.no_grad():
+            for audio_name in tqdm(missing, desc="Caching backbone features"):
+                spect_path = spectrogram_store.convert_spectrogram(
+                    spectrogram_dir, audio_name
+                )
+                num_segments = spectrogram_store.num_segments(spect_path)
+
+                features = []
+                for start in range(0, num_segments, batch_size):
+                    batch = spectrogram_store.load_segments(
+                        spect_path, start, start + batch_size
+                    )
+                    features.append(model.embed(batch.to(device)).cpu())
+                features = torch.cat(features).numpy().astype(np.float32)
+
+                # Write to a temporary file first so a crash never leaves a truncated cache entry
+                tmp_path = os.path.join(self.root, f"{audio_name}.tmp.npy")
+                np.save(tmp_path, features)
+                os.replace(tmp_path, self.path(audio_name))
+
+        # Drop the maps of the replaced files
+        open_features.cache_clear()
+
+        print(f">>> Cached backbone features for {len(missing)} audio files")
+        return len(missing)
@@ -0,0 +1,87 @@
+import os
+
+import torch
+from torch.utils.data import DataLoader
+
+# Input pipeline settings, see the README ("Training input pipeline")
+LOADER_WORKERS = int(os.getenv("LOADER_WORKERS", str(min(4, os.cpu_count() or 1))))
+LOADER_PREFETCH_FACTOR = int(os.getenv("LOADER_PREFETCH_FACTOR", "4"))
+LOADER_PERSISTENT_WORKERS = os.getenv("LOADER_PERSISTENT_WORKERS", "1") == "1"
+# "auto" pins host memory only when batches are copied to a GPU
+LOADER_PIN_MEMORY = os.getenv("LOADER_PIN_MEMORY", "auto")
+# Share of the currently available (host or GPU) memory that in-flight batches may use
+LOADER_MEMORY_FRACTION = float(os.getenv("LOADER_MEMORY_FRACTION", "0.25"))
+
+
+def available_memory(device):
+    """Bytes of memory currently available on `device`, or None if unknown."""
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def sample_nbytes(dataset):
+    """Size of one input sample of the dataset, in bytes."""
+    sample = dataset[0][0]
+    return sample.numel() * sample.element_size()
+
+
+def choose_batch_size(dataset, max_batch_size, device, num_workers=LOADER_WORKERS):
+    """Largest batch size up to `max_batch_size` whose in-flight batches fit in memory.
+
+    Every worker keeps `LOADER_PREFETCH_FACTOR` batches ready on top of the one being
+    computed, so they all count against the budget.
+    """
+    if len(dataset) == 0:
+        return max_batch_size
+    memory = available_memory(device)
+    if memory is None:
+        return max_batch_size
+
+    in_flight = 1 + max(num_workers, 1) * LOADER_PREFETCH_FACTOR
+    budget = memory * LOADER_MEMORY_FRACTION / in_flight
+    batch_size = int(budget // sample_nbytes(dataset))
+    return max(1, min(max_batch_size, batch_size))
+
+
+def make_loader(
+    dataset,
+    batch_size,
+    device,
+    shuffle=False,
+    collate_fn=None,
+    num_workers=LOADER_WORKERS,
+):
+    """DataLoader that decodes batches in worker processes and prefetches them.
+
+    Workers are only started for datasets that span several batches; for a handful of
+    samples, spawning them costs more than loading in the training thread.
+    """
+    if len(dataset) <= batch_size:
+        num_workers = 0
+
+    if LOADER_PIN_MEMORY == "auto":
+        pin_memory = device.type == "cuda"
+    else:
+        pin_memory = LOADER_PIN_MEMORY == "1"
+
+    options = {}
+    if num_workers > 0:
+        options = {
+            "prefetch_factor": LOADER_PREFETCH_FACTOR,
+            "persistent_workers": LOADER_PERSISTENT_WORKERS,
+        }
+
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        collate_fn=collate_fn,
+        **options,
+    )
@@ -1,159 +1,246 @@
+import copy
 import os
-import threading
 
 from dummy_server.constants import BIRDS_TO_LABELS, SPECTROGRAM_DIR
-from dummy_server.db.sqlite import db
-from dummy_server.model.datasets import LabeledSegmentDataset, AllSegmentDataset
+from dummy_server.db.sqlite import db, Audio
+from dummy_server.model.datasets import LabeledSegmentDataset
 from dummy_server.model.bird_classifier import Model
-from dummy_server.db.sqlite import  Uncertainty
+from dummy_server.model.feature_store import FeatureStore
+from dummy_server.model.loader import choose_batch_size, make_loader
+from dummy_server.model.scoring import ScoringScheduler
 
+import numpy as np
 import torch
 from tqdm import tqdm
-import numpy as np
 import torch.nn as nn
 from torch.optim import AdamW
 from torch.optim.lr_scheduler import CosineAnnealingLR
+from torch.utils.data import Subset
+
+# Upper bound, the actual batch size also depends on the available memory
+TRAIN_BATCH_SIZE = int(os.getenv("TRAIN_BATCH_SIZE", "4"))
+MAX_EPOCHS = int(os.getenv("RETRAIN_MAX_EPOCHS", "10"))
+# Epochs without improvement of the validation loss before training stops
+PATIENCE = int(os.getenv("RETRAIN_PATIENCE", "2"))
+# Old labels replayed per new label when fine-tuning, so the head does not forget them
+REPLAY_RATIO = float(os.getenv("RETRAIN_REPLAY_RATIO", "1.0"))
+MIN_REPLAY = int(os.getenv("RETRAIN_MIN_REPLAY", "32"))
+# Share of a retrain's labels held out to pick the number of epochs (then trained on as well)
+VALIDATION_FRACTION = 0.2
+VALIDATION_MAX_SIZE = 512
+LEARNING_RATE = 2e-4
+
+scorer = ScoringScheduler()
+
+# Model of the last retrain, kept in memory between retrains
+resident = {"model": None, "trained_labels": None}
+
+
+def load_model(device):
+    """Returns a copy of the resident model (loaded from the last checkpoint on the first
+    retrain) and the (segment id, label hash) pairs it was trained on, None if it is
+    untrained."""
+    if resident["model"] is None:
+        model = Model()
+        resident["trained_labels"] = model.load()
+        resident["model"] = model.to(device)
+        if resident["trained_labels"] is not None:
+            print(f">>> Warm start from a head trained on {len(resident['trained_labels'])} labels")
+
+    # Train a copy, so a scoring sweep still running with the previous model is not disturbed
+    return copy.deepcopy(resident["model"]), resident["trained_labels"]
+
+
+def split_labeled(segment_ids, label_hashes, trained_labels, rng):
+    """Returns the indices of the labeled segments to train on.
+
+    Without a previous model that is every label. Otherwise only the new labels (including
+    relabeled segments) are, plus a random replay sample of the old ones, so the cost of a
+    retrain grows with the number of new labels rather than with all labels.
+    """
+    if trained_labels is None:
+        return np.arange(len(segment_ids))
+
+    is_new = np.array(
+        [
+            (segment_id, label_hash) not in trained_labels
+            for segment_id, label_hash in zip(segment_ids.tolist(), label_hashes.tolist())
+        ],
+        dtype=bool,
+    )
+    new, old = np.flatnonzero(is_new), np.flatnonzero(~is_new)
+    if len(new) == 0:
+        return new
+
+    num_replay = min(len(old), max(MIN_REPLAY, int(REPLAY_RATIO * len(new))))
+    replay = rng.choice(old, num_replay, replace=False)
+    print(f">>> Fine-tuning on {len(new)} new and {num_replay} replayed labels")
+    return np.concatenate([new, replay])
+
+
+def holdout_split(indices, rng):
+    """Splits indices into (fit, validation), the validation part picking the number of
+    epochs."""
+    num_validation = min(VALIDATION_MAX_SIZE, int(len(indices) * VALIDATION_FRACTION))
+    shuffled = rng.permutation(indices)
+    return shuffled[num_validation:], shuffled[:num_validation]
+
+
+def validation_loss(model, loader, criterion, device):
+    model.eval()
+    total_loss = 0.0
+    with torch.no_grad():
+        for inputs, targets in loader:
+            inputs = inputs.to(device, non_blocking=True)
+            targets = targets.to(device, non_blocking=True)
+            total_loss += criterion(model.head(inputs), targets).item() * inputs.size(0)
+    return total_loss / len(loader.dataset)
+
+
+def train_head(model, train_set, val_set=None, device=None, epochs=None):
+    """Trains the classifier head, stopping early once the validation loss stops improving.
+
+    The weights of the best epoch are kept. Without validation data, trains for `epochs`
+    (default 3) epochs. Returns the number of epochs of the kept weights.
+    """
+    batch_size = choose_batch_size(train_set, TRAIN_BATCH_SIZE, device)
+    train_loader = make_loader(train_set, batch_size, device, shuffle=True)
+    val_loader = make_loader(val_set, batch_size, device) if val_set else None
+
+    print(
+        f"Training model with {len(train_set)} labeled segments in {len(train_loader)} batches"
+    )
+
+    if epochs is None:
+        epochs = MAX_EPOCHS if val_loader is not None else 3
+    best_epochs = epochs
+
+    # Loss, optimizer, scheduler
+    criterion = nn.BCEWithLogitsLoss()
+
+    optimizer = AdamW(model.parameters(), lr=LEARNING_RATE)
+    scheduler = CosineAnnealingLR(optimizer, T_max=epochs)
+
+    best_loss = float("inf")
+    best_state = None
+    epochs_without_improvement = 0
+
+    for epoch in range(epochs):
+        model.train()
+        train_loss = 0.0
+
+        # Wrapping the train_loader with tqdm for progress bar (notebook version)
+        with tqdm(
+            train_loader, unit="batch", desc=f"Epoch {epoch+1}/{epochs} Train"
+        ) as train_bar:
+            for inputs, targets in train_bar:
+                inputs = inputs.to(device, non_blocking=True)
+                targets = targets.to(device, non_blocking=True)
+
+                optimizer.zero_grad()
+                outputs = model.head(inputs)
+                loss = criterion(outputs, targets)
+                loss.backward()
+                optimizer.step()
+
+                train_loss += loss.item() * inputs.size(0)
+
+                # Update the tqdm description with current training loss
+                avg_loss = train_loss / (
+                    (train_bar.n + 1) * inputs.size(0)
+                )  # Correctly calculate average loss
+                train_bar.set_postfix(loss=avg_loss)
+
+        scheduler.step()
+        avg_train_loss = train_loss / len(train_set)
+        print(f"[Epoch {epoch+1}/{epochs}] Train Loss: {avg_train_loss:.4f}")
+
+        if val_loader is None:
+            continue
+
+        val_loss = validation_loss(model, val_loader, criterion, device)
+        print(f"[Epoch {epoch+1}/{epochs}] Validation Loss: {val_loss:.4f}")
+        if val_loss < best_loss:
+            best_loss = val_loss
+            best_state = copy.deepcopy(model.classifier_state_dict())
+            best_epochs = epoch + 1
+            epochs_without_improvement = 0
+        else:
+            epochs_without_improvement += 1
+            if epochs_without_improvement >= PATIENCE:
+                print(f">>> Early stopping after {epoch+1} epochs")
+                break
+
+    if best_state is not None:
+        model.load_classifier_state_dict(best_state)
+    return best_epochs
+
+
+def fit_head(model, dataset, indices, device, rng):
+    """Trains the head on `indices` of the labeled dataset.
+
+    A holdout of them picks the number of epochs by early stopping, then the head is trained
+    again from its initial weights on all of them (holdout included) for that many epochs, so
+    no label is left out of the model.
+    """
+    fit, validation = holdout_split(indices, rng)
+    if len(validation) == 0:
+        train_head(model, Subset(dataset, indices), device=device)
+        return
 
-from torch.utils.data import DataLoader
-from datetime import datetime, timezone
-from sqlalchemy import func
-
-# Use a shared dictionary for status
-status = {"retraining": False, "current_uncertainty": -1.0, "prev_uncertainty": -1.0}
-
+    initial_state = copy.deepcopy(model.classifier_state_dict())
+    epochs = train_head(
+        model, Subset(dataset, fit), Subset(dataset, validation), device
+    )
 
-def collate_fn(batch):
-    segments, segment_objs = zip(*batch)
-    return torch.stack(segments), list(segment_objs)
+    print(f">>> Final pass over all {len(indices)} labels for {epochs} epochs")
+    model.load_classifier_state_dict(initial_state)
+    train_head(model, Subset(dataset, indices), device=device, epochs=epochs)
 
 
 def retrain_loop(app):
+    """Runs a retrain; called by the model worker for every queued "retrain" job."""
     with app.app_context():
-        status["retraining"] = True
         print(">>> Starting retrain loop")
 
         session = db.session
 
-        train_dataset = LabeledSegmentDataset(session, SPECTROGRAM_DIR, BIRDS_TO_LABELS)
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         print(f">>> Using device: {device}")
 
-        # TODO: Possibly load a pre-trained model here
-        model = Model().to(device)
+        model, trained_labels = load_model(device)
 
-        if len(train_dataset) == 0:
-            print("No labeled data. Skipping training.")
-        else:
-            train_loader = DataLoader(
-                train_dataset, batch_size=4, shuffle=True, num_workers=0
-            )
-
-            print(
-                f"Training model with {len(train_dataset)} labeled segments in {len(train_loader)} batches"
-            )
-
-            epochs = 3  # between 7–12
-            lr = 2e-4
-
-            # Loss, optimizer, scheduler
-            criterion = nn.BCEWithLogitsLoss()
-
-            optimizer = AdamW(model.parameters(), lr=lr)
-            scheduler = CosineAnnealingLR(optimizer, T_max=epochs)
-
-            # Train for 3 epochs
-
-            for epoch in range(epochs):
-                model.train()
-                train_loss = 0.0
-
-                # Wrapping the train_loader with tqdm for progress bar (notebook version)
-                with tqdm(
-                    train_loader, unit="batch", desc=f"Epoch {epoch+1}/{epochs} Train"
-                ) as train_bar:
-                    for inputs, targets in train_bar:
-                        inputs, targets = inputs.to(device), targets.to(device)
-
-                        optimizer.zero_grad()
-                        outputs = model(inputs)
-                        loss = criterion(outputs, targets)
-                        loss.backward()
-                        optimizer.step()
-
-                        train_loss += loss.item() * inputs.size(0)
-
-                        # Update the tqdm description with current training loss
-                        avg_loss = train_loss / (
-                            (train_bar.n + 1) * inputs.size(0)
-                        )  # Correctly calculate average loss
-                        train_bar.set_postfix(loss=avg_loss)
-
-                scheduler.step()
-                avg_train_loss = train_loss / len(train_dataset)
-                print(f"[Epoch {epoch+1}/{epochs}] Train Loss: {avg_train_loss:.4f}")
-
-        model.save()
-
-        # Evaluate uncertainty (MI) for all segments and update DB
-        model.eval()
-        # all_segments = session.query(Segment).all()
-        uncertainties = []
-        mis = []
-
-        eval_dataset = AllSegmentDataset(session, SPECTROGRAM_DIR)
-        eval_loader = DataLoader(
-            eval_dataset,
-            batch_size=16,
-            shuffle=False,
-            num_workers=0,
-            collate_fn=collate_fn,
-        )
+        # The backbone is frozen, so run it once per segment and only train/evaluate the head
+        feature_store = FeatureStore(model.backbone_version)
+        audio_names = [
+            os.path.splitext(audio.filename)[0] for audio in session.query(Audio).all()
+        ]
+        feature_store.build(model, SPECTROGRAM_DIR, audio_names, device)
 
-        with torch.no_grad():
-            for segments, segment_objs in tqdm(
-                eval_loader, desc="Evaluating uncertainty"
-            ):
-                segments = segments.to(device)
-                _, batch_mi, batch_uncertainty = model.inference(segments, num_preds=10)
-
-                for seg_obj, mi_val, uncertainty_val in zip(
-                    segment_objs, batch_mi, batch_uncertainty
-                ):
-                    attached_seg = session.merge(seg_obj)
-                    attached_seg.uncertainty = round(mi_val.item(), 4)
-                    mis.append(mi_val.item())
-                    uncertainties.append(uncertainty_val.item())
-
-        session.commit()
-        average_uncertainty = np.mean(uncertainties)
-
-        # Create and add new Uncertainty record
-        new_uncertainty = Uncertainty(
-            value=float(f"{average_uncertainty:.4f}"),  # Format to 4 decimal places as float
-            created_at=datetime.now(timezone.utc),      # Current time (timezone-aware)
-            updated_at=datetime.now(timezone.utc)       # Will auto-update later if modified
+        labeled_dataset = LabeledSegmentDataset(
+            session, SPECTROGRAM_DIR, BIRDS_TO_LABELS, feature_store
         )
+        segment_ids = labeled_dataset.index.segment_ids
+        label_hashes = labeled_dataset.label_hashes
+        rng = np.random.default_rng()
+        train_indices = split_labeled(segment_ids, label_hashes, trained_labels, rng)
 
-        db.session.add(new_uncertainty)
-        db.session.commit()
-        print(f">>> Added new uncertainty record with value: {new_uncertainty.value:.4f} (ID: {new_uncertainty.id})")
+        if len(train_indices) == 0:
+            print("No new labeled data. Skipping training.")
+        else:
+            fit_head(model, labeled_dataset, train_indices, device, rng)
 
-        print(f">>> Updated uncertainties for {len(mis)} segments")
-        print(f">>> Average MI: {np.mean(mis):.4f}")
-        print(f">>> Average Uncertainty: {average_uncertainty}")
+            labels = list(zip(segment_ids.tolist(), label_hashes.tolist()))
+            trained_labels = set(trained_labels or ()) | {labels[i] for i in train_indices}
+            # Only the current labels, older versions of relabeled segments are gone
+            trained_labels &= set(labels)
+            model.save(trained_labels=trained_labels)
 
-        # save the uncertainty into the Uncertainty table
+        resident["model"] = model
+        resident["trained_labels"] = trained_labels
 
-        status["prev_uncertainty"] = status["current_uncertainty"]
-        status["current_uncertainty"] = average_uncertainty
-        status["retraining"] = False
+        # Re-score the unlabeled segments: candidates now, the rest in the background
+        scorer.start(app, model, feature_store, device, num_preds=10)
 
         print(">>> Retrain loop finished")
 
-
-def retrain(app):
-    if status["retraining"]:
-        print("Retrain already in progress")
-        return
-    thread = threading.Thread(target=retrain_loop, args=(app,), daemon=True)
-    thread.start()
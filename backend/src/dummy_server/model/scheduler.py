@@ -0,0 +1,76 @@
+import os
+import time
+
+from dummy_server.db.sqlite import count_jobs, enqueue_job, get_meta, set_meta
+
+# Label-count policy: retrain once this many labels came in (or were changed) since the last
+# retrain request
+RETRAIN_EVERY_LABELS = int(os.getenv("RETRAIN_EVERY_LABELS", "20"))
+# Time policy: retrain this often while there are new labels (0 disables it)
+RETRAIN_INTERVAL_SECONDS = int(os.getenv("RETRAIN_INTERVAL_SECONDS", "0"))
+# A queued retrain waits until no request came in for this long...
+RETRAIN_DEBOUNCE_SECONDS = float(os.getenv("RETRAIN_DEBOUNCE_SECONDS", "5"))
+# ...but not longer than this after it was first queued
+RETRAIN_MAX_DELAY_SECONDS = float(os.getenv("RETRAIN_MAX_DELAY_SECONDS", "60"))
+
+
+def retrain(app, delay=0, max_delay=None):
+    """Queues a retrain for the model worker. Returns the id of the queued job.
+
+    A retrain that is already waiting in the queue absorbs the request, since it will see
+    the new labels anyway. See `enqueue_job` for `delay` and `max_delay`.
+    """
+    with app.app_context():
+        job_id, queued = enqueue_job("retrain", delay=delay, max_delay=max_delay)
+    if not queued:
+        print("Retrain already queued")
+    return job_id
+
+
+def count_label_changes():
+    # Maintained by `label_segments`: new labels plus relabels that changed a segment's labels
+    return get_meta("label_changes", 0)
+
+
+def request_retrain(app, label_changes, reason):
+    """Queues a (debounced, coalesced) retrain covering the first `label_changes` changes."""
+    set_meta(
+        retrain_label_changes=label_changes, retrain_requested_at=int(time.time())
+    )
+    job_id = retrain(
+        app, delay=RETRAIN_DEBOUNCE_SECONDS, max_delay=RETRAIN_MAX_DELAY_SECONDS
+    )
+    print(f">>> Retrain requested ({reason}), job {job_id}")
+    return job_id
+
+
+def on_labels(app, label_changes):
+    """Label-count policy, checked after every label. Returns whether a retrain was requested."""
+    since_retrain = label_changes - get_meta("retrain_label_changes", 0)
+    if since_retrain < RETRAIN_EVERY_LABELS:
+        return False
+    request_retrain(app, label_changes, f"{since_retrain} new or changed labels")
+    return True
+
+
+def on_tick(app):
+    """Time policy, checked periodically by the model worker."""
+    if RETRAIN_INTERVAL_SECONDS <= 0:
+        return False
+
+    elapsed = time.time() - get_meta("retrain_requested_at", 0)
+    if elapsed < RETRAIN_INTERVAL_SECONDS:
+        return False
+
+    label_changes = count_label_changes()
+    if label_changes == get_meta("retrain_label_changes", 0):
+        return False
+    request_retrain(app, label_changes, f"{int(elapsed)}s since the last retrain")
+    return True
+
+
+def queue_status():
+    return {
+        "queued_retrains": count_jobs("queued", "retrain"),
+        "labels_since_retrain": count_label_changes() - get_meta("retrain_label_changes", 0),
+    }
@@ -0,0 +1,166 @@
+import os
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+import torch
+from torch.utils.data import Subset
+from tqdm import tqdm
+
+from dummy_server.constants import SPECTROGRAM_DIR
+from dummy_server.db.sqlite import (
+    db,
+    Uncertainty,
+    bulk_update_uncertainty,
+    set_meta,
+)
+from dummy_server.model.datasets import AllSegmentDataset
+from dummy_server.model.loader import choose_batch_size, make_loader
+
+# Number of current top candidates that are re-scored (and published) before anything else
+CANDIDATE_POOL_SIZE = 512
+# Number of segments re-scored (and committed) at a time by the background sweep
+SCORING_CHUNK_SIZE = 4096
+# Upper bound, the actual batch size also depends on the available memory
+SCORING_BATCH_SIZE = int(os.getenv("SCORING_BATCH_SIZE", "1024"))
+
+
+def collate_fn(batch):
+    segments, segment_ids = zip(*batch)
+    return torch.stack(segments), torch.tensor(segment_ids)
+
+
+class ScoringScheduler:
+    """Re-scores the uncertainty of unlabeled segments after a retrain.
+
+    Labeled segments are skipped. The current top candidates (by their previous score) are
+    scored first and committed right away, so `/audio` can serve fresh scores within seconds.
+    The rest of the corpus is then re-scored chunk by chunk in a background thread; a new
+    retrain supersedes a sweep that is still running. Progress is published in the `Meta`
+    table (`scoring`, `scored_segments`, `segments_to_score`) for the web server to report.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def start(self, app, model, feature_store, device, num_preds=10):
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+
+        session = db.session
+        dataset = AllSegmentDataset(
+            session, SPECTROGRAM_DIR, feature_store, unlabeled_only=True
+        )
+        pool_size = min(CANDIDATE_POOL_SIZE, len(dataset))
+        batch_size = choose_batch_size(dataset, SCORING_BATCH_SIZE, device)
+
+        set_meta(scoring=True, scored_segments=0, segments_to_score=len(dataset))
+
+        # Score the candidate pool synchronously and publish it
+        entropies = []
+        for ids, mis, batch_entropies in self._score_chunks(
+            model, Subset(dataset, range(pool_size)), batch_size, device, num_preds
+        ):
+            bulk_update_uncertainty(ids, mis)
+            entropies.extend(batch_entropies)
+        set_meta(scored_segments=pool_size)
+        print(f">>> Published fresh uncertainty for {pool_size} candidate segments")
+
+        thread = threading.Thread(
+            target=self._sweep,
+            args=(
+                app,
+                generation,
+                model,
+                dataset,
+                pool_size,
+                entropies,
+                batch_size,
+                device,
+                num_preds,
+            ),
+            daemon=True,
+        )
+        thread.start()
+        return thread
+
+    def _sweep(
+        self,
+        app,
+        generation,
+        model,
+        dataset,
+        start,
+        entropies,
+        batch_size,
+        device,
+        num_preds,
+    ):
+        with app.app_context():
+            session = db.session
+            scored = start
+            # One loader for the whole sweep, so its workers are started once
+            rest = Subset(dataset, range(start, len(dataset)))
+            for ids, mis, chunk_entropies in self._score_chunks(
+                model, rest, batch_size, device, num_preds
+            ):
+                if generation != self._generation:
+                    print(">>> Uncertainty sweep superseded by a newer model")
+                    return
+                bulk_update_uncertainty(ids, mis)
+                entropies.extend(chunk_entropies)
+                scored += len(ids)
+                set_meta(scored_segments=scored)
+
+            if generation != self._generation:
+                return
+            self._publish_average(session, entropies)
+            set_meta(scoring=False)
+
+    def _score_chunks(self, model, subset, batch_size, device, num_preds):
+        """Scores a subset of segments, yielding (ids, MI, predictive entropy) per chunk of
+        `SCORING_CHUNK_SIZE` segments."""
+        if len(subset) == 0:
+            return
+
+        loader = make_loader(subset, batch_size, device, collate_fn=collate_fn)
+
+        ids = []
+        mis = []
+        entropies = []
+        model.eval()
+        with torch.no_grad():
+            for segments, segment_ids in tqdm(loader, desc="Evaluating uncertainty"):
+                _, batch_mi, batch_uncertainty = model.inference_from_features(
+                    segments.to(device, non_blocking=True), num_preds=num_preds
+                )
+                ids.extend(segment_ids.tolist())
+                mis.extend(round(mi_val, 4) for mi_val in batch_mi.tolist())
+                entropies.extend(batch_uncertainty.tolist())
+
+                if len(ids) >= SCORING_CHUNK_SIZE:
+                    yield ids, mis, entropies
+                    ids, mis, entropies = [], [], []
+
+        if ids:
+            yield ids, mis, entropies
+
+    def _publish_average(self, session, entropies):
+        if not entropies:
+            return
+        average_uncertainty = float(np.mean(entropies))
+
+        # Save the average uncertainty into the Uncertainty table
+        new_uncertainty = Uncertainty(
+            value=float(f"{average_uncertainty:.4f}"),  # Format to 4 decimal places as float
+            created_at=datetime.now(timezone.utc),
+            updated_at=datetime.now(timezone.utc),
+        )
+        session.add(new_uncertainty)
+        session.commit()
+        print(
+            f">>> Added new uncertainty record with value: {new_uncertainty.value:.4f} (ID: {new_uncertainty.id})"
+        )
+        print(f">>> Updated uncertainties for {len(entropies)} unlabeled segments")
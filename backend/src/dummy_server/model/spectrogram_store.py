@@ -0,0 +1,173 @@
+import argparse
+import os
+from functools import lru_cache
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from dummy_server.constants import SPECTROGRAM_DIR
+
+SPECTROGRAM_FILENAME = "log_mel.npy"
+# Per-segment (offset, step) of the uint8 format
+SPECTROGRAM_SCALE_FILENAME = "log_mel_scale.npy"
+# Previous formats: ImageNet-normalized [num_segments, 3, 224, 224] tensors
+PREVIOUS_SPECTROGRAM_FILENAME = "spectrogram.npy"
+LEGACY_SPECTROGRAM_FILENAME = "spectrogram.pt"
+
+# float16 (6x smaller than the 3-channel float32 tensors) or uint8 (12x smaller)
+SPECTROGRAM_DTYPE = os.getenv("SPECTROGRAM_DTYPE", "float16")
+
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+_MEAN = torch.tensor(IMAGENET_MEAN).view(3, 1, 1)
+_STD = torch.tensor(IMAGENET_STD).view(3, 1, 1)
+
+
+def spectrogram_path(spectrogram_dir, audio_name):
+    return os.path.join(spectrogram_dir, audio_name, SPECTROGRAM_FILENAME)
+
+
+def scale_path(path):
+    return os.path.join(os.path.dirname(path), SPECTROGRAM_SCALE_FILENAME)
+
+
+def _save_npy(path, array):
+    # Write to a temporary file first so readers never map a half-written file
+    tmp_path = path[: -len(".npy")] + ".tmp.npy"
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+def save_spectrogram(path, log_mels, dtype=SPECTROGRAM_DTYPE):
+    """Stores `[num_segments, 224, 224]` resized log-mel spectrograms (in dB) as a flat .npy file
+    that can be memory-mapped.
+
+    With `dtype="uint8"`, every segment is quantized over its own range, and its offset and
+    step are kept in a small side file.
+    """
+    log_mels = np.asarray(log_mels, dtype=np.float32)
+    dtype = np.dtype(dtype)
+
+    if dtype == np.uint8:
+        offset = log_mels.min(axis=(1, 2))
+        step = np.maximum(log_mels.max(axis=(1, 2)) - offset, 1e-6) / 255.0
+        quantized = np.rint(
+            (log_mels - offset[:, None, None]) / step[:, None, None]
+        ).astype(np.uint8)
+        # The scale goes first, it must exist as soon as the data file does
+        _save_npy(scale_path(path), np.stack([offset, step], axis=1))
+        _save_npy(path, quantized)
+    elif dtype == np.float16:
+        _save_npy(path, log_mels.astype(np.float16))
+        if os.path.exists(scale_path(path)):
+            os.remove(scale_path(path))
+    else:
+        raise ValueError(f"Unsupported spectrogram dtype: {dtype}")
+
+
+@lru_cache(maxsize=64)
+def open_spectrogram(path):
+    """Memory-maps a spectrogram file (and its scale, if quantized); only the pages of the
+    segments we index are read."""
+    data = np.load(path, mmap_mode="r")
+    scale = np.load(scale_path(path)) if data.dtype == np.uint8 else None
+    return data, scale
+
+
+def num_segments(path):
+    return len(open_spectrogram(path)[0])
+
+
+def load_log_mels(path, index):
+    """Returns the float32 dB values of `open_spectrogram(path)[0][index]`."""
+    data, scale = open_spectrogram(path)
+    log_mels = np.array(data[index], dtype=np.float32)
+    if scale is not None:
+        offset, step = scale[index, 0], scale[index, 1]
+        log_mels = log_mels * step[..., None, None] + offset[..., None, None]
+    return log_mels
+
+
+def to_model_input(log_mels):
+    """Expands `[..., 224, 224]` dB values into ImageNet-normalized `[..., 3, 224, 224]`."""
+    images = torch.from_numpy(log_mels).unsqueeze(-3)
+    return (images - _MEAN) / _STD
+
+
+def load_segment(path, segment_index):
+    return to_model_input(load_log_mels(path, segment_index))  # [3, 224, 224]
+
+
+def load_segments(path, start, end):
+    return to_model_input(load_log_mels(path, slice(start, end)))  # [end - start, 3, 224, 224]
+
+
+def from_normalized(images):
+    """Recovers the dB values from ImageNet-normalized 3-channel tensors (all channels hold
+    the same spectrogram, so the first one is enough)."""
+    return np.asarray(images[:, 0], dtype=np.float32) * IMAGENET_STD[0] + IMAGENET_MEAN[0]
+
+
+def convert_spectrogram(
+    spectrogram_dir, audio_name, dtype=SPECTROGRAM_DTYPE, remove_previous=False
+):
+    """Converts `<audio_name>/spectrogram.npy` or `spectrogram.pt` into the compact format, if
+    needed."""
+    path = spectrogram_path(spectrogram_dir, audio_name)
+    if os.path.exists(path):
+        return path
+
+    previous_path = os.path.join(spectrogram_dir, audio_name, PREVIOUS_SPECTROGRAM_FILENAME)
+    legacy_path = os.path.join(spectrogram_dir, audio_name, LEGACY_SPECTROGRAM_FILENAME)
+    if os.path.exists(previous_path):
+        images = np.load(previous_path, mmap_mode="r")
+    elif os.path.exists(legacy_path):
+        images = torch.load(legacy_path).numpy()
+    else:
+        raise FileNotFoundError(f"Spectrogram file not found: {path}")
+
+    save_spectrogram(path, from_normalized(images), dtype=dtype)
+    if remove_previous:
+        for old_path in (previous_path, legacy_path):
+            if os.path.exists(old_path):
+                os.remove(old_path)
+    return path
+
+
+def convert_all(spectrogram_dir=SPECTROGRAM_DIR, dtype=SPECTROGRAM_DTYPE, remove_previous=False):
+    audio_names = [
+        name
+        for name in sorted(os.listdir(spectrogram_dir))
+        if not os.path.exists(spectrogram_path(spectrogram_dir, name))
+        and any(
+            os.path.exists(os.path.join(spectrogram_dir, name, filename))
+            for filename in (PREVIOUS_SPECTROGRAM_FILENAME, LEGACY_SPECTROGRAM_FILENAME)
+        )
+    ]
+    if not audio_names:
+        return 0
+
+    for audio_name in tqdm(audio_names, desc="Converting spectrograms"):
+        convert_spectrogram(spectrogram_dir, audio_name, dtype, remove_previous)
+
+    print(f">>> Converted {len(audio_names)} spectrograms to {SPECTROGRAM_FILENAME} ({dtype})")
+    return len(audio_names)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert spectrogram.pt / spectrogram.npy files into compact, memory-mappable "
+        "single-channel log_mel.npy files."
+    )
+    parser.add_argument("--spectrogram-dir", default=SPECTROGRAM_DIR)
+    parser.add_argument("--dtype", choices=["float16", "uint8"], default=SPECTROGRAM_DTYPE)
+    parser.add_argument(
+        "--remove-previous",
+        action="store_true",
+        help="Delete the spectrogram.pt / spectrogram.npy files once converted",
+    )
+    args = parser.parse_args()
+
+    convert_all(args.spectrogram_dir, args.dtype, args.remove_previous)
@@ -0,0 +1,117 @@
+import argparse
+import atexit
+import importlib
+import os
+import subprocess
+import sys
+import threading
+import traceback
+
+from flask import Flask
+
+from dummy_server.db.sqlite import (
+    db,
+    configure_db,
+    claim_job,
+    finish_job,
+    requeue_running_jobs,
+)
+from dummy_server.model.scheduler import on_tick
+
+# Where queued retrains run: "thread" (inside the web server process, for development),
+# "process" (a worker process started by the web server) or "external" (`start-worker`)
+RETRAIN_WORKER = os.getenv("RETRAIN_WORKER", "thread")
+WORKER_POLL_SECONDS = float(os.getenv("WORKER_POLL_SECONDS", "1.0"))
+
+# Job kind -> "module:function" running it, imported on the first job so that starting the
+# worker (or a web server running it in a thread) does not load torch
+JOBS = {"retrain": "dummy_server.model.retrain:retrain_loop"}
+
+
+def job_function(kind):
+    module_name, function_name = JOBS[kind].split(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def run_job(app, job_id, kind):
+    print(f">>> Running {kind} job {job_id}")
+    error = None
+    try:
+        job_function(kind)(app)
+    except Exception:
+        error = traceback.format_exc()
+        print(f">>> {kind} job {job_id} failed:\n{error}")
+
+    with app.app_context():
+        finish_job(job_id, error)
+
+
+def run_worker(app, poll_interval=WORKER_POLL_SECONDS, stop=None):
+    """Runs the jobs queued in the database, one at a time, until `stop` is set.
+
+    Only one worker should run per database: on startup, jobs left running by a previous
+    worker are put back in the queue.
+    """
+    stop = stop or threading.Event()
+    with app.app_context():
+        requeued = requeue_running_jobs()
+    if requeued:
+        print(f">>> Requeued {requeued} interrupted jobs")
+
+    print(">>> Model worker waiting for jobs")
+    while not stop.is_set():
+        with app.app_context():
+            on_tick(app)
+            job = claim_job()
+            job = (job.id, job.kind) if job is not None else None
+
+        if job is None:
+            stop.wait(poll_interval)
+            continue
+        run_job(app, *job)
+
+
+def start_worker(app, mode=RETRAIN_WORKER):
+    """Starts the model worker the way RETRAIN_WORKER asks for."""
+    if mode == "thread":
+        thread = threading.Thread(target=run_worker, args=(app,), daemon=True)
+        thread.start()
+        return thread
+
+    if mode == "process":
+        process = subprocess.Popen([sys.executable, "-m", "dummy_server.model.worker"])
+        atexit.register(process.terminate)
+        print(f">>> Started model worker process (pid {process.pid})")
+        return process
+
+    if mode == "external":
+        print(">>> Retrains run in a separate worker (`start-worker`)")
+        return None
+
+    raise ValueError(f"Unknown RETRAIN_WORKER: {mode}")
+
+
+def create_worker_app():
+    """Minimal app holding the database configuration; the worker serves no routes."""
+    app = Flask(__name__)
+    configure_db(app)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run queued retrain and scoring jobs.")
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=WORKER_POLL_SECONDS,
+        help="Seconds between two polls of an empty job queue",
+    )
+    args = parser.parse_args()
+
+    run_worker(create_worker_app(), poll_interval=args.poll_interval)
+
+
+if __name__ == "__main__":
+    main()
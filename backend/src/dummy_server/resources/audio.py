@@ -1,10 +1,37 @@
-from dummy_server.db.sqlite import Audio, Segment
+from dummy_server.cache.clips import clip_cache
+from dummy_server.cache.ogg_index import get_seek_index
+from dummy_server.db.sqlite import (
+    Audio,
+    db,
+    most_uncertain_segment,
+    window_segments,
+    unleased_candidates,
+    lease_segments,
+    release_leases,
+)
+from dummy_server.model.acquisition import select_batch
+from dummy_server.model.feature_store import FeatureStore, backbone_version
 from flask import jsonify, send_file, url_for, request
 from flask_restful import Resource
+from sqlalchemy.exc import IntegrityError
+from werkzeug.wsgi import wrap_file
 import os
 import random
+import subprocess
+import uuid
+import numpy as np
 from dummy_server import AUDIO_DIR
 
+BATCH_SIZE_DEFAULT = 8
+BATCH_SIZE_MAX = 32
+# How many of the most uncertain segments are considered per requested segment
+BATCH_CANDIDATE_FACTOR = 8
+# How long a handed out segment stays reserved for its annotator
+LEASE_SECONDS = 600
+# Cache-Control max-age of cut audio clips and raw audio files (revalidated through the ETag)
+CLIP_MAX_AGE = 24 * 60 * 60
+AUDIO_MAX_AGE = 60 * 60
+
 LOCATION_MAP = {
     "COL": "Jardín, Antioquia, Colombia",
     "COR": "Alajuela, San Ramón, Costa Rica",
@@ -24,58 +51,56 @@ def extract_location_from_filename(filename):
     return "Unknown"
 
 
+# Helper function that generates the metadata of a single 5 second segment (layman view)
+def get_segment_metadata(audio_id, filename, segment, scheme="http"):
+    start_time = float(segment.t_start)
+    end_time = start_time + 5.0
+    audio_url = (
+        url_for("audio_file", filename=filename, _external=True, _scheme=scheme)
+        + f"?start={start_time}&end={end_time}"
+    )
+
+    return {
+        "id": audio_id,
+        "filename": filename,
+        "duration": 5.0,  # Only 5 seconds for layman
+        "audio_url": audio_url,
+        "location": extract_location_from_filename(filename),
+        "segments": [
+            {
+                "id": segment.id,
+                "start_time": start_time,
+                "spectrogram_url": url_for(
+                    "spectrogram",
+                    file_name=filename.replace(".ogg", ""),
+                    segment_id=int(start_time) // 5,
+                    _external=True,
+                    _scheme=scheme,
+                ),
+                "uncertainty": segment.uncertainty,
+                "labels": [],
+            }
+        ],
+    }
+
+
 # Helper function that generates the metadata for both layman and expert views
-def get_audio_metadata(audio, segments, mode="expert"):
+def get_audio_metadata(audio, mode="expert"):
     location = extract_location_from_filename(audio.filename)
 
     # Dynamically determine scheme
     scheme = 'http'
-    
-    all_labeled_segments = Segment.query.filter((Segment.labels_json.isnot(None))).all()
-    print(f"/Labeled: we have {len(all_labeled_segments)} segments already labeled.")
+
+    # Single index probe, no ORM objects (see `most_uncertain_segment`)
+    most_uncertain = most_uncertain_segment()
 
     if mode == "layman":
-        # keep segments with no label
-        unlabeled_segments = Segment.query.filter((Segment.labels_json.is_(None))).all()
-        all_labeled_segments = Segment.query.filter((Segment.labels_json.isnot(None))).all()
-
-        print(f"/Unlabeled: we have {len(unlabeled_segments)} unlabeled segments.")
-        print(f"/Labeled: we have {len(all_labeled_segments)} segments already labeled.")
-
-        if unlabeled_segments:
-            most_uncertain_segment = max(unlabeled_segments, key=lambda s: s.uncertainty)
-            print(f"/Most_uncertain_segment labels are {most_uncertain_segment.labels}")
-            start_time = float(most_uncertain_segment.t_start)
-            end_time = start_time + 5.0
-            audio_url = (
-                url_for(
-                    "audio_file", filename=audio.filename, _external=True, _scheme=scheme
-                )
-                + f"?start={start_time}&end={end_time}"
-            )
+        if most_uncertain:
+            # Serve the segment from the audio it belongs to
+            if most_uncertain.audio_id != audio.id:
+                audio = db.session.get(Audio, most_uncertain.audio_id)
 
-            return {
-                "id": audio.id,
-                "filename": audio.filename,
-                "duration": 5.0,  # Only 5 seconds for layman
-                "audio_url": audio_url,
-                "location": location,
-                "segments": [
-                    {
-                        "id": most_uncertain_segment.id,
-                        "start_time": start_time,
-                        "spectrogram_url": url_for(
-                            "spectrogram",
-                            file_name=audio.filename.replace(".ogg", ""),
-                            segment_id=most_uncertain_segment.id,
-                            _external=True,
-                            _scheme=scheme,
-                        ),
-                        "uncertainty": most_uncertain_segment.uncertainty,
-                        "labels": [],
-                    }
-                ],
-            }
+            return get_segment_metadata(audio.id, audio.filename, most_uncertain, scheme)
         else:
             return {
                 "id": -1,
@@ -84,16 +109,14 @@ def get_audio_metadata(audio, segments, mode="expert"):
 
     else:
         # Find the most uncertain segment
-        unlabeled_segments = Segment.query.filter((Segment.labels_json.is_(None))).all()
-
-        most_uncertain_segment = max(unlabeled_segments, key=lambda s: s.uncertainty)
-        start_time = float(most_uncertain_segment.t_start)
+        start_time = float(most_uncertain.t_start) if most_uncertain else 0.0
         # Find the start of the minute window (previous full minute)
         minute_window_start = (start_time // 60) * 60
         minute_window_end = minute_window_start + 60.0
         print(f"Minute window start: {minute_window_start}, end: {minute_window_end}")
 
-        starting_segment_id = int(minute_window_start) // 5
+        # Only the 12 segments of the window, through the (audio_id, t_start) index
+        segments = window_segments(audio.id, minute_window_start, minute_window_end)
 
         audio_url = (
             url_for(
@@ -123,7 +146,7 @@ def get_audio_metadata(audio, segments, mode="expert"):
                     "uncertainty": segment.uncertainty,
                     "labels": segment.labels or [],
                 }
-                for segment in segments[starting_segment_id : starting_segment_id + 12]
+                for segment in segments
             ],
         }
 
@@ -147,13 +170,68 @@ class AudioRedirectResource(Resource):
             )  # Debug print
             return {"error": "Audio not found"}, 404
 
-        segments = (
-            Segment.query.filter_by(audio_id=audio.id).order_by(Segment.t_start).all()
-        )
         print(
             f"--- Returning audio metadata for '{chosen}' (mode: {mode}) ---"
         )  # Debug print
-        return jsonify(get_audio_metadata(audio, segments, mode))
+        return jsonify(get_audio_metadata(audio, mode))
+
+
+def get_candidate_embeddings(candidates):
+    """Cached backbone embeddings of the candidates, or None if some are not cached yet."""
+    feature_store = FeatureStore(backbone_version())
+    features = {}
+    embeddings = []
+    for candidate in candidates:
+        audio_name = os.path.splitext(candidate.filename)[0]
+        if audio_name not in features:
+            if not feature_store.has(audio_name):
+                return None
+            features[audio_name] = feature_store.load(audio_name)
+        embeddings.append(features[audio_name][int(candidate.t_start) // 5])
+    return np.stack(embeddings)
+
+
+# Handles requests to /audio/batch
+class AudioBatchResource(Resource):
+    def get(self):
+        k = request.args.get("k", default=BATCH_SIZE_DEFAULT, type=int)
+        if k is None or not 1 <= k <= BATCH_SIZE_MAX:
+            return {"error": f"k must be between 1 and {BATCH_SIZE_MAX}"}, 400
+
+        # Annotators pass back their token so their previous batch is released
+        lease_token = request.args.get("lease_token") or uuid.uuid4().hex
+
+        # Concurrent requests may pick the same candidates, the lease insert decides who wins
+        for _ in range(3):
+            release_leases(token=lease_token, expired=True)
+
+            candidates = unleased_candidates(k * BATCH_CANDIDATE_FACTOR)
+            chosen = [
+                candidates[i]
+                for i in select_batch(
+                    [c.uncertainty for c in candidates],
+                    get_candidate_embeddings(candidates),
+                    k,
+                )
+            ]
+
+            try:
+                expires_at = lease_segments([c.id for c in chosen], lease_token, LEASE_SECONDS)
+                break
+            except IntegrityError:
+                db.session.rollback()
+        else:
+            return {"error": "Could not reserve segments, please retry"}, 409
+
+        return jsonify(
+            {
+                "lease_token": lease_token,
+                "expires_at": expires_at.isoformat() + "Z",
+                "items": [
+                    get_segment_metadata(c.audio_id, c.filename, c) for c in chosen
+                ],
+            }
+        )
 
 
 # Handles requests to /audio/<filename>
@@ -165,10 +243,33 @@ class AudioResource(Resource):
         if not audio:
             return {"error": "Audio not found"}, 404
 
-        segments = (
-            Segment.query.filter_by(audio_id=audio.id).order_by(Segment.t_start).all()
-        )
-        return jsonify(get_audio_metadata(audio, segments, mode))
+        return jsonify(get_audio_metadata(audio, mode))
+
+
+def send_audio_file(path, **kwargs):
+    """`send_file` whose Range (206) responses can still go through the server's sendfile.
+
+    werkzeug streams ranges through a Python iterator, which hides the file from the server.
+    Instead, the file `send_file` opened is handed to the server's `wsgi.file_wrapper`,
+    positioned at the start of the range: gunicorn sends `Content-Length` bytes from the
+    current file offset. The file is never reopened by path, so a clip evicted from the cache
+    in the meantime is still served.
+    """
+    response = send_file(
+        path, mimetype="audio/ogg", as_attachment=False, conditional=True, **kwargs
+    )
+    if response.status_code == 206 and "wsgi.file_wrapper" in request.environ:
+        # `_RangeWrapper` around the server's (gunicorn: `.filelike`) or werkzeug's file wrapper
+        wrapper = getattr(response.response, "iterable", None)
+        f = getattr(wrapper, "filelike", None) or getattr(wrapper, "file", None)
+        if f is not None:
+            try:
+                f.seek(response.content_range.start)
+            except OSError:
+                # Not seekable: leave the range to werkzeug's iterator
+                return response
+            response.response = wrap_file(request.environ, f)
+    return response
 
 
 # Handles requests to /audio_file/<filename>
@@ -182,33 +283,60 @@ class AudioFileResource(Resource):
         end = request.args.get("end", type=float)
 
         if start is not None and end is not None:
-            import subprocess
-            import tempfile
+            if start < 0 or end <= start:
+                return {"error": "Invalid start/end."}, 400
+
+            # The clip can be evicted (by another request or worker) before `send_file` opens
+            # it, in which case it is cut again once
+            for _ in range(2):
+                try:
+                    clip_path = clip_cache.get_clip(filename, start, end)
+                except subprocess.CalledProcessError:
+                    return {"error": "Could not cut audio clip."}, 500
+
+                # A clip never changes for a given (filename, start, end), so let clients
+                # cache it
+                try:
+                    return send_audio_file(clip_path, max_age=CLIP_MAX_AGE)
+                except FileNotFoundError:
+                    continue
+            return {"error": "Audio clip is not available, try again."}, 503
+
+        # Conditional responses answer If-None-Match/If-Modified-Since with a 304 and Range
+        # requests with a 206, so seeking in the browser does not re-download the whole file
+        try:
+            return send_audio_file(file_path, etag=True, max_age=AUDIO_MAX_AGE)
+        except OSError:
+            return {"error": "File not found."}, 404
 
-            temp_file = tempfile.NamedTemporaryFile(suffix=".ogg", delete=False)
-            try:
-                subprocess.run(
-                    [
-                        "ffmpeg",
-                        "-y",
-                        "-i",
-                        file_path,
-                        "-ss",
-                        str(start),
-                        "-t",
-                        str(end - start),
-                        "-acodec",
-                        "copy",
-                        temp_file.name,
-                    ],
-                    check=True,
-                )
 
-                return send_file(
-                    temp_file.name, mimetype="audio/ogg", as_attachment=False
-                )
-            finally:
-                # Clean up the temporary file after sending
-                os.unlink(temp_file.name)
+# Handles requests to /audio_file/<filename>/seek
+class AudioSeekResource(Resource):
+    def get(self, filename):
+        file_path = os.path.join(AUDIO_DIR, filename)
+        if not os.path.isfile(file_path):
+            return {"error": "File not found."}, 404
+
+        start = request.args.get("start", default=0.0, type=float)
+        end = request.args.get("end", type=float)
 
-        return send_file(file_path, mimetype="audio/ogg", as_attachment=False)
+        try:
+            index = get_seek_index(filename)
+        except ValueError as e:
+            return {"error": str(e)}, 422
+
+        if end is None:
+            end = index.duration
+        if start < 0 or end <= start:
+            return {"error": "Invalid start/end."}, 400
+
+        byte_start, byte_end = index.byte_range(start, end)
+
+        # Inclusive ranges, as used in HTTP "Range: bytes=<first>-<last>" headers
+        return {
+            "audio_url": url_for("audio_file", filename=filename, _external=True),
+            "content_length": index.size,
+            "duration": index.duration,
+            "header_range": [0, index.header_bytes - 1],
+            "byte_range": [byte_start, byte_end - 1],
+        }, 200
@@ -1,14 +1,40 @@
-from dummy_server.db.sqlite import Audio, Segment, db
-from dummy_server.model.retrain import retrain
+import os
+
+from dummy_server.db.sqlite import Audio, Segment, db, label_segments, release_leases
+from dummy_server.model.scheduler import on_labels
 from flask import current_app, request
 from flask_restful import Resource
-from datetime import datetime, timezone
 from dummy_server.constants import MAPPING_DICT
 
+# Most segments accepted by one `/labels` request
+MAX_LABEL_BATCH = int(os.getenv("MAX_LABEL_BATCH", "500"))
+
+
+def map_labels(names):
+    """Maps label names to their codes. Returns (codes, names that are not in MAPPING_DICT)."""
+    unknown = [name for name in names if not isinstance(name, str) or name not in MAPPING_DICT]
+    if unknown:
+        return None, unknown
+    return [MAPPING_DICT[name] for name in names], []
+
+
+def submit_labels(labels_by_segment):
+    """Stores `{segment_id: codes}` and queues a retrain if enough labels came in."""
+    labeled_count, label_changes = label_segments(labels_by_segment)
+
+    # The segments are done, they no longer need to be reserved
+    release_leases(segment_ids=list(labels_by_segment))
+    print(f"Labeled counts are {labeled_count}")
+
+    # Queue a retrain if enough labels came in or changed since the last one
+    return on_labels(current_app._get_current_object(), label_changes)
+
 
 class LabelResource(Resource):
     def post(self):
-        data = request.get_json()
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return {"error": "Missing or invalid fields"}, 400
 
         audio_filename = data.get("audio_filename")
         segment_id = data.get("segment_id")
@@ -17,7 +43,9 @@ class LabelResource(Resource):
         if not all([audio_filename, segment_id is not None, isinstance(labels, list)]):
             return {"error": "Missing or invalid fields"}, 400
 
-        mapped_labels = [MAPPING_DICT[hola] for hola in labels]
+        mapped_labels, unknown = map_labels(labels)
+        if unknown:
+            return {"error": "Unknown labels", "unknown_labels": unknown}, 400
 
         # Find audio
         audio = Audio.query.filter_by(filename=audio_filename).first()
@@ -29,20 +57,71 @@ class LabelResource(Resource):
         if not segment:
             return {"error": "Segment not found"}, 404
 
-        # Update labels
-        segment.labels = mapped_labels
-        segment.uncertainty = 0
-        segment.updated_at = datetime.now(timezone.utc)
-        db.session.commit()
+        retrain = submit_labels({segment.id: mapped_labels})
+        return {"message": "Labels updated successfully", "retrain": retrain}, 200
+
+
+class LabelBatchResource(Resource):
+    """Labels many segments in one request and one transaction, e.g. a whole expert window.
+
+    Expects `{"labels": [{"segment_id": ..., "labels": [...]}, ...]}`, optionally with an
+    `audio_filename` that all the segments must belong to. Nothing is stored unless every
+    entry is valid.
+    """
+
+    def post(self):
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return {"error": "Missing or invalid fields"}, 400
+        items = data.get("labels")
+        audio_filename = data.get("audio_filename")
+
+        if not isinstance(items, list) or not items:
+            return {"error": "Missing or invalid fields"}, 400
+        if len(items) > MAX_LABEL_BATCH:
+            return {"error": f"At most {MAX_LABEL_BATCH} segments per request"}, 400
+
+        labels_by_segment = {}
+        errors = []
+        for index, item in enumerate(items):
+            item = item if isinstance(item, dict) else {}
+            segment_id = item.get("segment_id")
+            labels = item.get("labels")
+            if type(segment_id) is not int or not isinstance(labels, list):
+                errors.append({"index": index, "error": "Missing or invalid fields"})
+                continue
+
+            mapped_labels, unknown = map_labels(labels)
+            if unknown:
+                errors.append(
+                    {
+                        "index": index,
+                        "segment_id": segment_id,
+                        "error": "Unknown labels",
+                        "unknown_labels": unknown,
+                    }
+                )
+                continue
+            labels_by_segment[segment_id] = mapped_labels
+
+        if errors:
+            return {"error": "Invalid labels", "errors": errors}, 400
 
-        # Count how many segments are labeled
-        labeled_count = Segment.query.filter(Segment.labels_json.isnot(None)).count()
-        print(f"Labeled counts are {labeled_count}")
+        query = db.session.query(Segment.id).filter(Segment.id.in_(labels_by_segment))
+        if audio_filename:
+            audio = Audio.query.filter_by(filename=audio_filename).first()
+            if not audio:
+                return {"error": "Audio file not found"}, 404
+            query = query.filter(Segment.audio_id == audio.id)
 
-        # Check for retraining condition
-        if labeled_count % 20 == 0:
-            retrain(current_app._get_current_object())
-            return {"message": "Labels updated successfully", "retrain": True}, 200
-        else:
-            return {"message": "Labels updated successfully", "retrain": False}, 200
+        found = {segment_id for (segment_id,) in query}
+        missing = sorted(set(labels_by_segment) - found)
+        if missing:
+            return {"error": "Segment not found", "segment_ids": missing}, 404
 
+        retrain = submit_labels(labels_by_segment)
+        return {
+            "message": "Labels updated successfully",
+            "labeled": len(labels_by_segment),
+            "retrain": retrain,
+        }, 200
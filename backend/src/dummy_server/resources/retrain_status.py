@@ -1,16 +1,29 @@
 from flask_restful import Resource
-from dummy_server.model.retrain import status
 from flask_cors import cross_origin
-from dummy_server.db.sqlite import Uncertainty
+from dummy_server.db.sqlite import Uncertainty, count_jobs, get_meta
+from dummy_server.model.scheduler import queue_status
 
 
 class RetrainStatusResource(Resource):
     @cross_origin()
     def get(self):
+        # Published by the model worker, which may run in another process
+        latest = (
+            Uncertainty.query.with_entities(Uncertainty.value)
+            .order_by(Uncertainty.id.desc())
+            .limit(2)
+            .all()
+        )
+        uncertainties = [unc.value for unc in latest] + [-1.0, -1.0]
+
         return {
-            "status": "retraining" if status["retraining"] else "ready",
-            "current_uncertainty": status["current_uncertainty"],
-            "prev_uncertainty": status["prev_uncertainty"],
+            "status": "retraining" if count_jobs("running", "retrain") else "ready",
+            "current_uncertainty": uncertainties[0],
+            "prev_uncertainty": uncertainties[1],
+            "scoring": bool(get_meta("scoring", 0)),
+            "scored_segments": get_meta("scored_segments", 0),
+            "segments_to_score": get_meta("segments_to_score", 0),
+            **queue_status(),
         }, 200
 
 
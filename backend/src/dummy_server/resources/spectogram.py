@@ -2,7 +2,8 @@ from flask import send_file
 from flask_restful import Resource
 import os
 
-from dummy_server.constants import SPECTROGRAM_DIR
+from dummy_server.cache.spectrograms import spectrogram_cache
+from dummy_server.constants import SPECTROGRAM_DIR, SPECTROGRAM_RENDER_ON_MISS
 
 
 class SpectrogramResource(Resource):
@@ -12,6 +13,15 @@ class SpectrogramResource(Resource):
         file_path = os.path.join(folder_path, image_filename)
 
         if not os.path.isfile(file_path):
-            return {"error": f"Spectrogram not found"}, 404
+            # Not pre-rendered: render it from the audio now (and cache it for next time)
+            file_path = (
+                spectrogram_cache.get_image(file_name, segment_id)
+                if SPECTROGRAM_RENDER_ON_MISS
+                else None
+            )
+            if file_path is None:
+                return {"error": f"Spectrogram not found"}, 404
 
-        return send_file(file_path, mimetype="image/png", as_attachment=False)
+        return send_file(
+            file_path, mimetype="image/png", as_attachment=False, conditional=True
+        )
@@ -1,28 +1,85 @@
 import argparse
+import atexit
 import os
+import subprocess
+import sys
 
-from dummy_server.db.sqlite import init_db
+from dummy_server.db.sqlite import configure_db, init_db
 
-from dummy_server.model.retrain import retrain
-from flask import Flask, url_for, request
+from dummy_server.model.scheduler import count_label_changes, request_retrain
+from dummy_server.model.worker import RETRAIN_WORKER, run_worker, start_worker
+from dummy_server.router.startup import Startup, StartupReport
+from flask import Flask, jsonify, url_for, request
 from flask_cors import CORS
 from flask_restful import Api
 
 from dummy_server.downloader.download import download_data
 from dummy_server.resources.audio import (
     AudioRedirectResource,
+    AudioBatchResource,
     AudioResource,
     AudioFileResource,
+    AudioSeekResource,
 )
 from dummy_server.resources.spectogram import SpectrogramResource
-from dummy_server.resources.label import LabelResource
+from dummy_server.resources.label import LabelBatchResource, LabelResource
 from dummy_server.resources.retrain_status import RetrainStatusResource, StatsResource
-from dummy_server.downloader.generate_spectograms import generate_spectrograms
 
-from dummy_server.constants import AUDIO_DIR, SPECTROGRAM_DIR
+from dummy_server.constants import AUDIO_DIR, SPECTROGRAM_DIR, STARTUP_REPORT_PATH
 
+# Routes that answer while the startup phases are still running
+STARTUP_EXEMPT_ENDPOINTS = {"hello_world", "healthz", "readyz"}
 
-def create_app():
+# Production server settings, see `start_server`
+SERVER_MODE = os.getenv("SERVER_MODE", "gunicorn")
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", str(min(2 * (os.cpu_count() or 1) + 1, 8))))
+WEB_THREADS = int(os.getenv("WEB_THREADS", "8"))
+WEB_TIMEOUT = int(os.getenv("WEB_TIMEOUT", "120"))
+WEB_KEEPALIVE = int(os.getenv("WEB_KEEPALIVE", "5"))
+
+
+def prepare_data():
+    download_data()
+    print("Audio files:", os.listdir(AUDIO_DIR))
+    print("Spectrogram folders:", os.listdir(SPECTROGRAM_DIR))
+
+
+def queue_initial_retrain(app):
+    print('About to retrain !')
+    with app.app_context():
+        request_retrain(app, count_label_changes(), "startup")
+
+
+def add_startup_phases(startup, app, model_worker=True):
+    # TODO: Replace with S3 & MongoDB in the future if there is time
+    startup.add("download", prepare_data)
+    # generate_spectrograms(AUDIO_DIR, SPECTROGRAM_DIR, segment_duration=5)
+    startup.add("database", lambda: init_db(app))
+    if model_worker:
+        startup.add("worker", lambda: start_worker(app), required=False)
+    startup.add("initial_retrain", lambda: queue_initial_retrain(app), required=False)
+
+
+def run_setup(report_path):
+    """Setup process of the production server.
+
+    Runs the startup phases once for all web workers, which follow them through
+    `report_path`, then stays on as the model worker (unless RETRAIN_WORKER is "external").
+    """
+    app = Flask(__name__)
+    configure_db(app)
+
+    startup = Startup(report_path)
+    add_startup_phases(startup, app, model_worker=False)
+    startup.run()
+
+    if startup.ready and RETRAIN_WORKER != "external":
+        run_worker(app)
+
+
+def create_app(startup=None):
+    """Creates the app. Without `startup`, the startup phases run in a background thread of
+    this process; otherwise the app only reports (and waits for) the given startup."""
     app = Flask(__name__)
 
     # Set server name and scheme from environment variables
@@ -33,25 +90,35 @@ def create_app():
 
     CORS(app, resources={r"/*": {"origins": "*"}})
 
-    # Initial setup
-    # TODO: Replace with S3 & MongoDB in the future if there is time
-    download_data()
+    # Extensions must be registered before the first request, so the database is bound now;
+    # creating and filling it is left to the startup phases
+    configure_db(app)
 
-    print()
-    print()
+    # Initial setup, run in the background so the server accepts connections right away
+    run_startup = startup is None
+    if run_startup:
+        startup = Startup()
+        add_startup_phases(startup, app)
+    app.extensions["startup"] = startup
 
-    # generate_spectrograms(AUDIO_DIR, SPECTROGRAM_DIR, segment_duration=5)
+    @app.before_request
+    def wait_for_startup():
+        if startup.ready or request.endpoint in STARTUP_EXEMPT_ENDPOINTS:
+            return None
+        response = jsonify({"error": "Server is starting up", **startup.report()})
+        response.status_code = 503
+        response.headers["Retry-After"] = "5"
+        return response
 
-    init_db(app)
+    # Liveness: the process is up, with the progress of the startup phases
+    @app.route("/healthz")
+    def healthz():
+        return jsonify(startup.report()), 200
 
-    print()
-    print()
-
-    print('About to retrain !')
-    retrain(app)
-
-    print()
-    print()
+    # Readiness: every required startup phase is done
+    @app.route("/readyz")
+    def readyz():
+        return jsonify(startup.report()), 200 if startup.ready else 503
 
     # Initialize Flask-RESTful Api directly with the app instance
     # This ensures the API and its routes are properly associated with the app
@@ -59,18 +126,25 @@ def create_app():
 
     # Add all resources directly to the api instance
     api.add_resource(AudioRedirectResource, "/audio")
+    api.add_resource(AudioBatchResource, "/audio/batch")
     api.add_resource(
         AudioResource, "/audio/<string:filename>", endpoint="audio_resource"
     )
     api.add_resource(
         AudioFileResource, "/audio_file/<string:filename>", endpoint="audio_file"
     )
+    api.add_resource(
+        AudioSeekResource,
+        "/audio_file/<string:filename>/seek",
+        endpoint="audio_seek",
+    )
     api.add_resource(
         SpectrogramResource,
         "/spectrograms/<string:file_name>/<int:segment_id>",
         endpoint="spectrogram",
     )
     api.add_resource(LabelResource, "/label")
+    api.add_resource(LabelBatchResource, "/labels")
     api.add_resource(RetrainStatusResource, "/retrain/status")
     api.add_resource(StatsResource, "/stats")
 
@@ -90,8 +164,8 @@ def create_app():
             )
         print("-----------------------------\n")
 
-    print("Audio files:", os.listdir(AUDIO_DIR))
-    print("Spectrogram folders:", os.listdir(SPECTROGRAM_DIR))
+    if run_startup:
+        startup.start()
 
     return app
 
@@ -113,14 +187,85 @@ def start_server():
     parser.add_argument(
         "--debug",
         action="store_true",
-        help="Run Flask in debug mode",
+        help="Run Flask in debug mode (implies --server dev)",
+    )
+    parser.add_argument(
+        "--server",
+        choices=["gunicorn", "dev"],
+        default=SERVER_MODE,
+        help="gunicorn (production, worker processes) or the Flask development server",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=WEB_WORKERS,
+        help="Web worker processes (gunicorn)",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=WEB_THREADS,
+        help="Threads per web worker (gunicorn)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=int,
+        default=WEB_TIMEOUT,
+        help="Seconds before a stuck web worker is restarted (gunicorn)",
+    )
+    parser.add_argument(
+        "--keep-alive",
+        type=int,
+        default=WEB_KEEPALIVE,
+        help="Seconds to keep idle connections open (gunicorn)",
+    )
+    # Internal: runs the setup process of the production server
+    parser.add_argument("--setup", metavar="REPORT_PATH", help=argparse.SUPPRESS)
 
     args = parser.parse_args()
 
-    server_app = create_app()
+    if args.setup:
+        run_setup(args.setup)
+    elif args.server == "dev" or args.debug:
+        server_app = create_app()
+        server_app.run(debug=args.debug, host=args.host, port=args.port)
+    else:
+        serve_production(args)
+
+
+def serve_production(args):
+    """Serves the app with gunicorn.
+
+    The startup side effects (download, database, first retrain) and the model worker run
+    once, in a single setup process, rather than once per web worker. Files are sent with
+    sendfile(2), so `/audio_file` (Range requests included, see `send_audio_file`) and
+    `/spectrograms` bodies do not go through Python.
+    """
+    from dummy_server.router.production import GunicornApplication
+
+    os.makedirs(os.path.dirname(STARTUP_REPORT_PATH), exist_ok=True)
+    if os.path.exists(STARTUP_REPORT_PATH):
+        os.remove(STARTUP_REPORT_PATH)
+
+    setup = subprocess.Popen(
+        [sys.executable, "-m", "dummy_server.router.app", "--setup", STARTUP_REPORT_PATH]
+    )
+    atexit.register(setup.terminate)
 
-    server_app.run(debug=args.debug, host=args.host, port=args.port)
+    options = {
+        "bind": f"{args.host}:{args.port}",
+        "workers": args.workers,
+        "worker_class": "gthread",
+        "threads": args.threads,
+        "timeout": args.timeout,
+        "graceful_timeout": 30,
+        "keepalive": args.keep_alive,
+        "sendfile": True,
+        "accesslog": "-",
+    }
+    GunicornApplication(
+        lambda: create_app(startup=StartupReport(STARTUP_REPORT_PATH)), options
+    ).run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,21 @@
+from gunicorn.app.base import BaseApplication
+
+
+class GunicornApplication(BaseApplication):
+    """Runs the app factory under gunicorn, from the `start-server` entry point.
+
+    The factory is called in every worker process (the app is not preloaded in the master),
+    so the master stays single-threaded and forks cleanly.
+    """
+
+    def __init__(self, app_factory, options):
+        self.app_factory = app_factory
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.app_factory()
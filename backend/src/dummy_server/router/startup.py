@@ -0,0 +1,113 @@
+import json
+import os
+import threading
+import time
+import traceback
+
+
+class Startup:
+    """Runs the startup phases in a background thread and records how each of them went.
+
+    The server is ready once every phase marked `required` is done; the other phases (such as
+    queueing the first retrain) are only reported. With `report_path`, the report is also
+    written to that file after every change, for other processes to read (see
+    `StartupReport`).
+    """
+
+    def __init__(self, report_path=None):
+        self.started_at = time.time()
+        self.phases = {}  # name -> phase record, in the order they are run
+        self.report_path = report_path
+        self._lock = threading.Lock()
+
+    def _set(self, name, **values):
+        with self._lock:
+            self.phases[name].update(values)
+        if self.report_path is not None:
+            self.write_report()
+
+    def write_report(self):
+        tmp_path = f"{self.report_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.report(), f)
+        os.replace(tmp_path, self.report_path)
+
+    def add(self, name, function, required=True):
+        self.phases[name] = {
+            "function": function,
+            "required": required,
+            "state": "pending",
+            "started_after": None,
+            "duration": None,
+            "error": None,
+        }
+
+    def run(self):
+        for name, phase in self.phases.items():
+            start = time.time()
+            self._set(name, state="running", started_after=round(start - self.started_at, 3))
+            print(f">>> Startup phase '{name}' started")
+            try:
+                phase["function"]()
+            except Exception:
+                error = traceback.format_exc()
+                print(f">>> Startup phase '{name}' failed:\n{error}")
+                self._set(name, state="failed", error=error.splitlines()[-1])
+                # Later phases depend on the earlier ones
+                return
+            finally:
+                self._set(name, duration=round(time.time() - start, 3))
+            self._set(name, state="done")
+            print(f">>> Startup phase '{name}' done in {self.phases[name]['duration']}s")
+
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    @property
+    def ready(self):
+        with self._lock:
+            return all(
+                phase["state"] == "done"
+                for phase in self.phases.values()
+                if phase["required"]
+            )
+
+    def report(self):
+        with self._lock:
+            phases = {
+                name: {key: value for key, value in phase.items() if key != "function"}
+                for name, phase in self.phases.items()
+            }
+        return {
+            "ready": self.ready,
+            "started_at": self.started_at,
+            "uptime": round(time.time() - self.started_at, 3),
+            "phases": phases,
+        }
+
+
+class StartupReport:
+    """Read-only view of the report a `Startup` in another process writes to `path`."""
+
+    def __init__(self, path):
+        self.path = path
+        self._ready = False
+
+    def report(self):
+        try:
+            with open(self.path) as f:
+                report = json.load(f)
+        except FileNotFoundError:
+            return {"ready": False, "started_at": None, "uptime": None, "phases": {}}
+        # The file is only rewritten when a phase changes, so the uptime is recomputed
+        report["uptime"] = round(time.time() - report["started_at"], 3)
+        return report
+
+    @property
+    def ready(self):
+        # Once ready, the server stays ready, so the file is no longer read on every request
+        if not self._ready:
+            self._ready = self.report()["ready"]
+        return self._ready